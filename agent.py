@@ -14,15 +14,28 @@ def notebook_pretty_print(data):
 
 
 import os
+import re
 import json
+import time
+import copy
+import uuid
+import hashlib
 import asyncio
 import logging
-from typing import Dict, Any, List, Union
+import functools
+from collections import OrderedDict, deque, defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Union, Optional, Callable, AsyncGenerator
 
+from pydantic import PrivateAttr
 from google.genai import types
 
-from google.adk.agents import Agent, SequentialAgent
-from google.adk.sessions import InMemorySessionService
+from google.adk.agents import Agent, BaseAgent, SequentialAgent
+from google.adk.agents.invocation_context import InvocationContext
+from google.adk.events import Event, EventActions
+from google.adk.models import BaseLlm, Gemini, LlmRequest, LlmResponse
+from google.adk.sessions import BaseSessionService, InMemorySessionService, Session
+from google.adk.sessions.base_session_service import GetSessionConfig, ListSessionsResponse
 from google.adk.runners import Runner
 from google.adk.tools import agent_tool
 
@@ -66,11 +79,97 @@ def _ensure_google_api_key() -> None:
     )
 
 
-_ensure_google_api_key()
+# Model-call cassettes: "record" writes every stage's request/response to disk,
+# "replay" serves them back without touching the network; "off" disables both.
+CASSETTE_MODE = os.getenv("RUBRIQ_CASSETTE_MODE", "off")
+CASSETTE_PATH = os.getenv("RUBRIQ_CASSETTE", "rubriq_cassette.jsonl")
+CASSETTE_MATCH = os.getenv("RUBRIQ_CASSETTE_MATCH", "strict")  # strict | fuzzy
+
+# Replaying a cassette needs no network access, hence no API key.
+if CASSETTE_MODE != "replay":
+    _ensure_google_api_key()
 os.environ.setdefault("GOOGLE_GENAI_USE_VERTEXAI", "False")
 
 MODEL_NAME = "gemini-2.0-flash"
 
+# Deadlines (seconds). A stage deadline bounds every single model call made by
+# one agent; the grading deadline bounds a whole run_session query.
+STAGE_TIMEOUT_S = 60.0
+GRADING_TIMEOUT_S = 180.0
+
+# Hedged requests: once a stage has enough latency samples, a call that has not
+# answered by the stage's p95 latency gets a duplicate; the first answer wins.
+HEDGE_ENABLED = True
+HEDGE_PERCENTILE = 95.0
+HEDGE_MIN_SAMPLES = 20
+# Every Nth call that could be hedged runs unhedged instead, so the backend's
+# own tail stays measurable once hedging hides it (0 disables the holdout).
+HEDGE_HOLDOUT_EVERY = 20
+
+# Local static checks run before scoring and hand compact, pre-verified facts
+# (comments, README, hardcoded secrets, agent concepts) to the scoring agent.
+STATIC_CHECKS_ENABLED = True
+
+# Feedback mode: "llm" runs the feedback agent inline, "deferred" returns the
+# scores at once and generates the comment later, "template" renders the
+# comment locally from scores and reasons.
+FEEDBACK_MODE = "llm"
+DEFERRED_FEEDBACK_BACKGROUND = True
+# Deferred comments (pending or generated) are kept this long after their last
+# submit, then dropped; get() on an expired ticket raises KeyError.
+FEEDBACK_TICKET_TTL_S = 900.0
+
+# Point-annotated rubrics ("Writeup (15 points)") are compiled locally into a
+# grading plan; the analysis LLM is only called for unstructured rubrics.
+RUBRIC_COMPILER_ENABLED = True
+RUBRIC_MIN_CRITERIA = 2
+
+# Map-reduce analysis: submissions whose writeup + code exceed the threshold
+# are split into chunks at semantic boundaries, summarised in parallel and
+# reduced hierarchically instead of being sent whole to the analysis agent.
+MAP_REDUCE_ENABLED = True
+MAP_REDUCE_THRESHOLD_CHARS = 120_000
+MAP_CHUNK_CHARS = 24_000
+MAP_CONCURRENCY = 4
+REDUCE_FAN_IN = 6
+CHUNK_SUMMARY_CACHE_SIZE = 4096
+
+# Packed scoring: small submissions sharing a rubric are scored several per
+# request (rubric and instruction sent once) by grade_batch_packed().
+PACK_MAX_SUBMISSION_CHARS = 8_000
+PACK_MAX_ITEMS = 5
+PACK_MAX_CHARS = 40_000
+
+# Stage overlap: "sequential" runs analysis then scoring; "speculative" streams
+# the analysis and scores each criterion as soon as it has been emitted.
+STAGE_OVERLAP = "sequential"
+SPECULATIVE_CONCURRENCY = 4
+SPECULATIVE_CRITERIA_ESTIMATE = 6  # scoring calls budgeted when the rubric has no list or point lines
+
+# Scheduler in front of the pipeline: priority classes are served strictly in
+# this order; tenants (user_id) within a class share capacity by weighted fair
+# queuing, each capped at TENANT_MAX_CONCURRENCY running gradings.
+PRIORITY_CLASSES = ("interactive", "batch")
+SCHEDULER_MAX_CONCURRENCY = 8
+TENANT_MAX_CONCURRENCY = 2
+
+# Pre-flight token budgets (prompt + expected output tokens, all stages).
+# Oversized submissions are digested down to the budget, or rejected if even
+# the digest does not fit. None disables a budget.
+ADMISSION_CONTROL_ENABLED = True
+SUBMISSION_TOKEN_BUDGET: Optional[int] = 200_000
+BATCH_TOKEN_BUDGET: Optional[int] = None
+
+# Concurrent grade() calls with the same payload and pipeline configuration
+# share one execution. Completed results can also be kept for a short TTL
+# (0 disables the result cache).
+COALESCE_ENABLED = True
+RESULT_CACHE_TTL_S = 0.0
+
+# Ephemeral gradings run against a throwaway session that is released as soon
+# as grade() returns, instead of a named session kept in session_service.
+EPHEMERAL_SESSIONS = False
+
 
 # -------------------------------------------------------------------
 # Agent instructions
@@ -96,6 +195,15 @@ You are the SCORING AGENT.
 You receive JSON containing 'rubric_text', 'project_writeup', 'code_text', and 'analysis_result'.
 Score each criterion based on evidence.
 
+'static_evidence' below is computed locally from the code and writeup.
+Its 'verified' facts are exact (comment counts, line numbers of hardcoded secrets and contact details):
+treat them as true, do not re-derive them, and cite them in reasons where relevant.
+Its 'hints' come from keyword heuristics (documentation cues, agent concepts mentioned): use them
+as pointers only and confirm them against the submission before relying on them.
+If it only has 'unavailable', no static checks ran: judge from the submission alone.
+
+static_evidence: {static_evidence?}
+
 Output STRICT JSON ONLY:
 {
   "scores": [{ "criterion": "...", "score": ..., "max_score": ..., "reason": "..." }]
@@ -119,46 +227,1969 @@ The user ALWAYS sends you a JSON object.
 2) Return the tool's JSON result AS-IS.
 """
 
+PACKED_SCORING_INSTRUCTION = """
+You are the SCORING AGENT, scoring SEVERAL independent submissions against the same rubric.
+The rubric is given once. Each submission is delimited by
+<<<SUBMISSION id=...>>> and <<<END SUBMISSION id=...>>> and contains JSON with
+'project_writeup', 'code_text', 'analysis_result' and 'static_evidence'.
+Score every criterion of each submission's analysis_result based only on that submission's evidence.
+Treat the 'verified' part of static_evidence as true; its 'hints' are heuristics to confirm.
+
+Output STRICT JSON ONLY, one entry per submission id:
+{
+  "results": [{ "id": "...", "scores": [{ "criterion": "...", "score": ..., "max_score": ..., "reason": "..." }] }]
+}
+"""
+
+CHUNK_SUMMARY_INSTRUCTION = """
+You are the CHUNK SUMMARY AGENT in a judge team for a coding project.
+You receive ONE part of a larger submission: either a slice of its code or of its writeup.
+Summarise it for a judge: purpose, main components, techniques and agent concepts used,
+and any notable problems (missing comments, hardcoded secrets, errors).
+Plain text, at most 150 words.
+"""
+
+REDUCE_INSTRUCTION = """
+You are the REDUCE AGENT in a judge team for a coding project.
+You receive several partial summaries of the SAME submission, in order.
+Merge them into one coherent summary without losing concrete facts.
+Plain text, at most 250 words.
+"""
+
 
 # -------------------------------------------------------------------
-# Build sub-agents (LLM)
+# Stage deadlines, cancellation & hedged requests
 # -------------------------------------------------------------------
 
-analysis_agent = Agent(
-    name="rubriq_analysis_agent",
-    model=MODEL_NAME,
-    instruction=ANALYSIS_INSTRUCTION,
-    output_key="analysis_result",
-)
+class StageDeadlineExceeded(asyncio.TimeoutError):
+    """Raised when a stage's model call misses its deadline."""
+
+
+class LatencyTracker:
+    """Rolling window of latency samples (seconds) with percentile lookups."""
+
+    def __init__(self, window: int = 500):
+        self._samples = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        idx = min(len(ordered) - 1, max(0, round(q / 100.0 * (len(ordered) - 1))))
+        return ordered[idx]
+
+    def summary(self) -> Dict[str, Any]:
+        n = len(self._samples)
+        return {
+            "count": n,
+            "mean_s": (sum(self._samples) / n) if n else None,
+            "p50_s": self.percentile(50),
+            "p95_s": self.percentile(95),
+            "p99_s": self.percentile(99),
+        }
+
+
+def _clone_request(llm_request: LlmRequest) -> LlmRequest:
+    # Backends may append to contents / tweak config in place, so a hedge
+    # must never share those objects with the primary call.
+    return llm_request.model_copy(
+        update={
+            "contents": list(llm_request.contents),
+            "config": llm_request.config.model_copy(deep=True),
+        }
+    )
+
+
+class ResilientLlm(BaseLlm):
+    """
+    Wraps a stage's backend model with a per-call deadline and optional hedging.
+
+    Calls are unary: the backend's responses are collected before being yielded,
+    so a call that misses its deadline is cancelled without leaking partial output.
+    """
+
+    inner: BaseLlm
+    stage: str
+    timeout_s: Optional[float] = STAGE_TIMEOUT_S
+    hedge: bool = HEDGE_ENABLED
+
+    # Backend latency (one sample per call, including copies cancelled after
+    # losing a race) drives the hedge delay; unhedged latency (warm-up and
+    # holdout calls) is the baseline that stage latency (what the agent
+    # observed) is compared with to show the tail improvement.
+    _call_latency: LatencyTracker = PrivateAttr(default_factory=LatencyTracker)
+    _unhedged_latency: LatencyTracker = PrivateAttr(default_factory=LatencyTracker)
+    _stage_latency: LatencyTracker = PrivateAttr(default_factory=LatencyTracker)
+    _armed: int = PrivateAttr(default=0)
+    _stats: Dict[str, int] = PrivateAttr(
+        default_factory=lambda: {
+            "calls": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "errors": 0, "cancelled_losers": 0,
+        }
+    )
+
+    @property
+    def capabilities(self):
+        return self.inner.capabilities
+
+    async def _call_once(self, llm_request: LlmRequest) -> List[LlmResponse]:
+        started = time.perf_counter()
+        try:
+            responses = [r async for r in self.inner.generate_content_async(llm_request, stream=False)]
+        except asyncio.CancelledError:
+            # A copy that lost the race (or hit the deadline) took at least
+            # this long; dropping it would hide exactly the slow calls.
+            self._stats["cancelled_losers"] += 1
+            self._call_latency.record(time.perf_counter() - started)
+            raise
+        self._call_latency.record(time.perf_counter() - started)
+        return responses
+
+    def _hedge_delay(self) -> Optional[float]:
+        if not self.hedge or len(self._call_latency) < HEDGE_MIN_SAMPLES:
+            return None
+        self._armed += 1
+        if HEDGE_HOLDOUT_EVERY and self._armed % HEDGE_HOLDOUT_EVERY == 0:
+            return None
+        return self._call_latency.percentile(HEDGE_PERCENTILE)
+
+    async def _race(self, llm_request: LlmRequest) -> List[LlmResponse]:
+        hedge_after = self._hedge_delay()
+        if hedge_after is None:
+            started = time.perf_counter()
+            responses = await self._call_once(llm_request)
+            self._unhedged_latency.record(time.perf_counter() - started)
+            return responses
+        spare = _clone_request(llm_request)
+
+        primary = asyncio.ensure_future(self._call_once(llm_request))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if not done:
+                self._stats["hedged"] += 1
+                pending.add(asyncio.ensure_future(self._call_once(spare)))
+                logging.info("[%s] hedging after %.2fs", self.stage, hedge_after)
+
+            # First successful answer wins; a failed call only loses the race
+            # if another copy is still in flight.
+            while True:
+                if not pending:
+                    return primary.result()
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self._stats["hedge_wins"] += 1
+                        return task.result()
+                    if not pending:
+                        raise task.exception()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _stream(self, llm_request: LlmRequest) -> AsyncGenerator[LlmResponse, None]:
+        # Partial output cannot be raced, so streamed calls are never hedged;
+        # the stage deadline covers the whole stream (timeout_s=None: no deadline).
+        deadline = None if self.timeout_s is None else time.perf_counter() + self.timeout_s
+        responses = self.inner.generate_content_async(llm_request, stream=True)
+        try:
+            while True:
+                remaining = None if deadline is None else max(deadline - time.perf_counter(), 0.0)
+                try:
+                    yield await asyncio.wait_for(responses.__anext__(), remaining)
+                except StopAsyncIteration:
+                    return
+        finally:
+            await responses.aclose()
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        self._stats["calls"] += 1
+        started = time.perf_counter()
+        if stream:
+            try:
+                async for response in self._stream(llm_request):
+                    yield response
+            except asyncio.TimeoutError:
+                self._stats["timeouts"] += 1
+                raise StageDeadlineExceeded(
+                    f"Stage '{self.stage}' exceeded its {self.timeout_s}s deadline."
+                ) from None
+            except Exception:
+                self._stats["errors"] += 1
+                raise
+            self._stage_latency.record(time.perf_counter() - started)
+            return
+        try:
+            responses = await asyncio.wait_for(self._race(llm_request), self.timeout_s)
+        except asyncio.TimeoutError:
+            self._stats["timeouts"] += 1
+            raise StageDeadlineExceeded(
+                f"Stage '{self.stage}' exceeded its {self.timeout_s}s deadline."
+            ) from None
+        except Exception:
+            self._stats["errors"] += 1
+            raise
+        self._stage_latency.record(time.perf_counter() - started)
+        for response in responses:
+            yield response
+
+    def report(self) -> Dict[str, Any]:
+        calls = self._stats["calls"]
+        return {
+            **self._stats,
+            "hedge_rate": (self._stats["hedged"] / calls) if calls else 0.0,
+            "backend_latency": self._call_latency.summary(),
+            "unhedged_latency": self._unhedged_latency.summary(),
+            "stage_latency": self._stage_latency.summary(),
+        }
+
+
+class FakeLlm(BaseLlm):
+    """
+    Offline backend for exercising deadlines and hedging.
+    `reply` is returned verbatim (or computed from the request); `latency_fn`
+    injects a per-call delay in seconds. Streamed calls spread that delay over
+    `stream_chunks` partial responses, followed by the complete text.
+    A reply may also be a types.Content (e.g. a function call, see
+    fake_orchestrator_reply), which is returned as one response.
+    """
+
+    reply: Union[str, types.Content, Callable[[LlmRequest], Union[str, types.Content]]] = "{}"
+    latency_fn: Optional[Callable[[], float]] = None
+    stream_chunks: int = 8
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        delay = self.latency_fn() if self.latency_fn is not None else 0.0
+        text = self.reply(llm_request) if callable(self.reply) else self.reply
+        if isinstance(text, types.Content):
+            await asyncio.sleep(delay)
+            yield LlmResponse(content=text)
+            return
+        if stream:
+            step = max(1, -(-len(text) // self.stream_chunks))
+            for start in range(0, len(text), step):
+                await asyncio.sleep(delay / self.stream_chunks)
+                yield LlmResponse(
+                    content=types.Content(role="model", parts=[types.Part(text=text[start:start + step])]),
+                    partial=True,
+                )
+        else:
+            await asyncio.sleep(delay)
+        yield LlmResponse(content=types.Content(role="model", parts=[types.Part(text=text)]))
+
+
+def fake_orchestrator_reply(llm_request: LlmRequest) -> types.Content:
+    """
+    FakeLlm reply for the orchestrator stage: calls the rubriq_pipeline tool
+    with the user's JSON, then returns the tool's result as-is.
+    """
+    parts = [part for content in llm_request.contents for part in (content.parts or [])]
+    for part in reversed(parts):
+        if part.function_response is not None:
+            response = part.function_response.response or {}
+            result = response.get("result", response)
+            text = result if isinstance(result, str) else json.dumps(result, ensure_ascii=False)
+            return types.Content(role="model", parts=[types.Part(text=text)])
+    query = next((part.text for part in parts if part.text), "")
+    call = types.FunctionCall(name="rubriq_pipeline", args={"request": query})
+    return types.Content(role="model", parts=[types.Part(function_call=call)])
 
-scoring_agent = Agent(
-    name="rubriq_scoring_agent",
-    model=MODEL_NAME,
-    instruction=SCORING_INSTRUCTION,
-    output_key="scoring_result",
-)
 
-feedback_agent = Agent(
-    name="rubriq_feedback_agent",
-    model=MODEL_NAME,
-    instruction=FEEDBACK_INSTRUCTION,
-    output_key="rubriq_output",
+# -------------------------------------------------------------------
+# Record / replay cassettes for model calls
+# -------------------------------------------------------------------
+
+class CassetteMiss(LookupError):
+    """Raised in replay mode when a request has no recorded response."""
+
+
+def _normalize_text(text: str, fuzzy: bool) -> str:
+    text = " ".join(text.split())
+    return text.lower() if fuzzy else text
+
+
+def _request_key(stage: str, llm_request: LlmRequest, fuzzy: bool = False) -> str:
+    """
+    Hash of a normalized request. Volatile parts (function-call ids) are dropped.
+    Fuzzy keys also ignore case, the system instruction, model and tools, so a
+    cassette keeps replaying across prompt edits.
+    """
+    contents = []
+    for content in llm_request.contents:
+        for part in content.parts or []:
+            if part.text:
+                contents.append([content.role, _normalize_text(part.text, fuzzy)])
+            elif part.function_call:
+                contents.append([content.role, "call", part.function_call.name, part.function_call.args])
+            elif part.function_response:
+                contents.append(
+                    [content.role, "response", part.function_response.name, part.function_response.response]
+                )
+    doc = {"stage": stage, "contents": contents}
+    if not fuzzy:
+        instruction = llm_request.config.system_instruction if llm_request.config else None
+        doc["model"] = llm_request.model
+        doc["instruction"] = _normalize_text(str(instruction or ""), fuzzy)
+        doc["tools"] = sorted(llm_request.tools_dict)
+    blob = json.dumps(doc, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+class Cassette:
+    """
+    On-disk store of model responses keyed by normalized request hash (JSON lines).
+    Entries are loaded into memory up front so replay never touches the disk.
+    """
+
+    def __init__(self, path: str = CASSETTE_PATH, mode: str = "replay", match: str = "strict"):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode '{mode}'; expected 'record' or 'replay'.")
+        if match not in ("strict", "fuzzy"):
+            raise ValueError(f"Unknown cassette match '{match}'; expected 'strict' or 'fuzzy'.")
+        self.path, self.mode, self.match = path, mode, match
+        self._strict: Dict[str, List[LlmResponse]] = {}
+        self._fuzzy: Dict[str, List[LlmResponse]] = {}
+        self.stats = {"hits": 0, "fuzzy_hits": 0, "misses": 0, "recorded": 0}
+        self.misses: List[Dict[str, str]] = []
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                responses = [LlmResponse.model_validate_json(r) for r in entry["responses"]]
+                self._strict[entry["key"]] = responses
+                self._fuzzy[entry["fuzzy_key"]] = responses
+
+    def lookup(self, stage: str, llm_request: LlmRequest) -> List[LlmResponse]:
+        responses = self._strict.get(_request_key(stage, llm_request))
+        if responses is not None:
+            self.stats["hits"] += 1
+        elif self.match == "fuzzy":
+            responses = self._fuzzy.get(_request_key(stage, llm_request, fuzzy=True))
+            if responses is not None:
+                self.stats["fuzzy_hits"] += 1
+        if responses is None:
+            self.stats["misses"] += 1
+            last = llm_request.contents[-1] if llm_request.contents else None
+            preview = (last.parts[0].text or "")[:80] if last and last.parts else ""
+            self.misses.append({"stage": stage, "key": _request_key(stage, llm_request), "preview": preview})
+            raise CassetteMiss(f"No recorded response for stage '{stage}'.")
+        return [r.model_copy(deep=True) for r in responses]
+
+    def record(self, stage: str, llm_request: LlmRequest, responses: List[LlmResponse]) -> None:
+        entry = {
+            "stage": stage,
+            "key": _request_key(stage, llm_request),
+            "fuzzy_key": _request_key(stage, llm_request, fuzzy=True),
+            "responses": [r.model_dump_json(exclude_none=True) for r in responses],
+        }
+        self._strict[entry["key"]] = self._fuzzy[entry["fuzzy_key"]] = responses
+        with open(self.path, "a", encoding="utf-8") as fh:
+            fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.stats["recorded"] += 1
+
+    def report(self) -> Dict[str, Any]:
+        return {"path": self.path, "mode": self.mode, "match": self.match, **self.stats, "missed": self.misses}
+
+
+class CassetteLlm(BaseLlm):
+    """Records the inner backend's responses to a cassette, or replays them from it."""
+
+    inner: BaseLlm
+    stage: str
+    cassette: Cassette
+
+    async def generate_content_async(
+        self, llm_request: LlmRequest, stream: bool = False
+    ) -> AsyncGenerator[LlmResponse, None]:
+        if self.cassette.mode == "replay":
+            responses = self.cassette.lookup(self.stage, llm_request)
+        else:
+            # Key on the request as the agent built it, before the backend mutates it.
+            key_request = _clone_request(llm_request)
+            responses = [r async for r in self.inner.generate_content_async(llm_request, stream=stream)]
+            self.cassette.record(self.stage, key_request, responses)
+        for response in responses:
+            yield response
+
+
+_active_cassette: Optional[Cassette] = None
+
+
+def use_cassette(path: str = CASSETTE_PATH, mode: str = "replay", match: str = "strict") -> Cassette:
+    """Route every stage (current and future) through a cassette."""
+    global _active_cassette
+    _active_cassette = Cassette(path, mode, match)
+    for stage, wrapped in STAGE_MODELS.items():
+        backend = wrapped.inner.inner if isinstance(wrapped.inner, CassetteLlm) else wrapped.inner
+        wrapped.inner = CassetteLlm(model=backend.model, inner=backend, stage=stage, cassette=_active_cassette)
+    return _active_cassette
+
+
+# One wrapped model per stage, so latency history is shared by every agent
+# instance of that stage.
+STAGE_MODELS: Dict[str, ResilientLlm] = {}
+
+
+_backend_factory: Optional[Callable[[str], BaseLlm]] = None
+
+
+def _stage_model(stage: str) -> ResilientLlm:
+    if stage not in STAGE_MODELS:
+        backend: BaseLlm = _backend_factory(stage) if _backend_factory is not None else Gemini(model=MODEL_NAME)
+        if _active_cassette is not None:
+            backend = CassetteLlm(model=backend.model, inner=backend, stage=stage, cassette=_active_cassette)
+        STAGE_MODELS[stage] = ResilientLlm(model=MODEL_NAME, inner=backend, stage=stage)
+    return STAGE_MODELS[stage]
+
+
+def install_backend(factory: Callable[[str], BaseLlm]) -> None:
+    """Swap the backend behind every stage, current and future (e.g. a FakeLlm with injected latency)."""
+    global _backend_factory
+    _backend_factory = factory
+    for stage, wrapped in STAGE_MODELS.items():
+        if isinstance(wrapped.inner, CassetteLlm):
+            wrapped.inner.inner = factory(stage)
+        else:
+            wrapped.inner = factory(stage)
+
+
+def resilience_report() -> Dict[str, Any]:
+    """Per-stage hedge rates, timeouts and backend vs. observed latency percentiles."""
+    return {stage: wrapped.report() for stage, wrapped in STAGE_MODELS.items()}
+
+
+if CASSETTE_MODE != "off":
+    use_cassette(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_MATCH)
+
+
+# -------------------------------------------------------------------
+# Static checks (deterministic evidence for objective criteria)
+# -------------------------------------------------------------------
+
+# name -> check(payload) -> compact facts. Register extra checks with @static_check.
+# Checks computing exact facts are "verified"; keyword heuristics are reported
+# to the scorer as hints (verified=False).
+STATIC_CHECKS: Dict[str, Callable[[Dict[str, Any]], Dict[str, Any]]] = {}
+HEURISTIC_CHECKS = set()
+
+
+def static_check(name: str, verified: bool = True):
+    def register(fn):
+        STATIC_CHECKS[name] = fn
+        if not verified:
+            HEURISTIC_CHECKS.add(name)
+        return fn
+    return register
+
+
+@static_check("comments")
+def _check_comments(payload: Dict[str, Any]) -> Dict[str, Any]:
+    lines = [l.strip() for l in payload.get("code_text", "").splitlines() if l.strip()]
+    comment_lines = sum(1 for l in lines if l.startswith("#"))
+    inline_comments = sum(1 for l in lines if not l.startswith("#") and re.search(r"\s#\s", l))
+    docstrings = sum(l.count('"""') + l.count("'''") for l in lines) // 2
+    return {
+        "has_comments": bool(comment_lines or inline_comments or docstrings),
+        "comment_lines": comment_lines,
+        "inline_comments": inline_comments,
+        "docstrings": docstrings,
+        "comment_ratio": round(comment_lines / len(lines), 3) if lines else 0.0,
+    }
+
+
+# Concrete install/run steps only; prose such as "no setup required" must not count.
+_SETUP_STEPS = re.compile(
+    r"pip install \S|requirements\.txt|pyproject\.toml|npm install|git clone|docker (run|compose)"
+    r"|python3? (-m \w|\S+\.py)|adk (run|web)|how to (install|run)|^#+ *(setup|installation|usage)\b",
+    re.IGNORECASE | re.MULTILINE,
 )
 
-pipeline_agent = SequentialAgent(
-    name="rubriq_pipeline",
-    description="Sequential pipeline: analysis, scoring, feedback.",
-    sub_agents=[analysis_agent, scoring_agent, feedback_agent],
+
+@static_check("documentation", verified=False)
+def _check_documentation(payload: Dict[str, Any]) -> Dict[str, Any]:
+    writeup = payload.get("project_writeup", "")
+    corpus = f"{writeup}\n{payload.get('code_text', '')}"
+    # The payload has no README field unless the caller adds one.
+    readme = payload.get("readme_text")
+    return {
+        "readme_provided": bool(readme.strip()) if isinstance(readme, str) else "unknown",
+        "readme_referenced": bool(re.search(r"\breadme\b", corpus, re.IGNORECASE)),
+        "setup_steps_found": bool(_SETUP_STEPS.search(corpus)),
+        "writeup_words": len(writeup.split()),
+    }
+
+
+_SECRET_PATTERNS = {
+    "google_api_key": re.compile(r"AIza[0-9A-Za-z_\-]{35}"),
+    "openai_api_key": re.compile(r"\bsk-[A-Za-z0-9_\-]{20,}"),
+    "assigned_secret": re.compile(
+        r"\b(api[_-]?key|secret|password|passwd|token)\b\s*[:=]\s*[\"']([^\"']{4,})[\"']",
+        re.IGNORECASE,
+    ),
+}
+_PLACEHOLDER = re.compile(r"your|here|xxx|placeholder|changeme|<.*>", re.IGNORECASE)
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+")
+# A bare run of digits is a timestamp or a constant as often as a phone number,
+# so a number counts only when it is formatted like one (country code,
+# separators) or the line names it (phone, whatsapp, mobile, ...).
+_PHONE_FORMATTED = re.compile(
+    r"(?<![\w@.+])(?:\+\d{1,3}[\s.-]?\(?\d{1,4}\)?[\s.-]?\d{3,5}[\s.-]?\d{3,5}"
+    r"|\(?\d{3}\)?[\s.-]\d{3}[\s.-]\d{4}|\d{5}[\s-]\d{5})(?![\w@])"
 )
+_PHONE_DIGITS = re.compile(r"(?<![\w@.])\+?\d[\d\s().-]{8,18}\d(?![\w@])")
+_PHONE_CONTEXT = re.compile(r"phone|whats_?app|mobile|\btel\b|\bcell\b|contact_?(no|num)", re.IGNORECASE)
+
+
+def _digit_count(text: str) -> int:
+    return sum(ch.isdigit() for ch in text)
+
+
+def _has_phone(line: str) -> bool:
+    if any(10 <= _digit_count(m.group(0)) <= 15 for m in _PHONE_FORMATTED.finditer(line)):
+        return True
+    return bool(_PHONE_CONTEXT.search(line)) and any(
+        10 <= _digit_count(m.group(0)) <= 13 for m in _PHONE_DIGITS.finditer(line)
+    )
+
+
+@static_check("secrets")
+def _check_secrets(payload: Dict[str, Any]) -> Dict[str, Any]:
+    # Only line numbers are reported; matched values never leave this function.
+    secret_lines, placeholder_lines, email_lines, phone_lines = [], [], [], []
+    for lineno, line in enumerate(payload.get("code_text", "").splitlines(), start=1):
+        for kind, pattern in _SECRET_PATTERNS.items():
+            match = pattern.search(line)
+            if not match:
+                continue
+            value = match.group(2) if kind == "assigned_secret" else match.group(0)
+            (placeholder_lines if _PLACEHOLDER.search(value) else secret_lines).append(lineno)
+            break
+        if _EMAIL.search(line):
+            email_lines.append(lineno)
+        if _has_phone(line):
+            phone_lines.append(lineno)
+    return {
+        "hardcoded_secret_lines": secret_lines,
+        "placeholder_key_lines": placeholder_lines,
+        "email_lines": email_lines,
+        "phone_number_lines": phone_lines,
+    }
+
+
+_AGENT_CONCEPTS = {
+    "multi_agent": r"SequentialAgent|ParallelAgent|LoopAgent|sub_agents|multi[- ]agent",
+    "tools": r"FunctionTool|AgentTool|agent_tool|MCPToolset|google_search|\btools\s*=",
+    "sessions_memory": r"SessionService|session_service|MemoryService|chat_session|(chat|conversation)_history",
+    "context_engineering": r"system_prompt|global_context|instruction\s*=|context window|compaction",
+    "observability": r"\blogging\b|\blogger\b|opentelemetry|tracing|RUN_ID",
+    "evaluation": r"AgentEvaluator|eval_set|evalset|adk eval\b",
+    "a2a": r"\bA2A\b|RemoteA2aAgent|to_a2a",
+    "deployment": r"Agent Engine|Cloud Run|Hugging Face Spaces|adk deploy|gcloud run deploy",
+    "gemini": r"\bgemini\b|gemini-[\w.-]+|\bgenai\b",
+}
+
+
+@static_check("agent_concepts", verified=False)
+def _check_agent_concepts(payload: Dict[str, Any]) -> Dict[str, Any]:
+    sources = {"code": payload.get("code_text", ""), "writeup": payload.get("project_writeup", "")}
+    found = {}
+    for concept, pattern in _AGENT_CONCEPTS.items():
+        where = [name for name, text in sources.items() if re.search(pattern, text, re.IGNORECASE)]
+        if where:
+            found[concept] = where
+    return {"count_in_code": sum("code" in w for w in found.values()), "found": found}
+
+
+def run_static_checks(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Run every registered check, grouped into exact "verified" facts and
+    heuristic "hints". A failing check is reported, not raised. Without code
+    or writeup (e.g. an unparsable payload) there is nothing to verify, and
+    the evidence only says so.
+    """
+    if not any(key in payload for key in ("code_text", "project_writeup")):
+        return {"unavailable": "no code_text or project_writeup in the payload"}
+    evidence = {"verified": {}, "hints": {}}
+    for name, check in STATIC_CHECKS.items():
+        group = evidence["hints" if name in HEURISTIC_CHECKS else "verified"]
+        try:
+            group[name] = check(payload)
+        except Exception as exc:
+            logging.warning("Static check '%s' failed: %s", name, exc)
+            group[name] = {"error": str(exc)}
+    return evidence
+
+
+def _payload_from_ctx(ctx: InvocationContext) -> Dict[str, Any]:
+    # The pipeline's user message is the orchestrator's JSON payload.
+    content = ctx.user_content
+    text = content.parts[0].text if content and content.parts else None
+    try:
+        payload = json.loads(text or "")
+    except json.JSONDecodeError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
+class StaticEvidenceAgent(BaseAgent):
+    """Computes static evidence locally (no model call) and stores it in state."""
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        started = time.perf_counter()
+        evidence = run_static_checks(_payload_from_ctx(ctx))
+        logging.info("[%s] static checks in %.1fms", self.name, (time.perf_counter() - started) * 1000)
+        yield Event(
+            author=self.name,
+            invocation_id=ctx.invocation_id,
+            branch=ctx.branch,
+            actions=EventActions(
+                state_delta={"static_evidence": json.dumps(evidence, separators=(",", ":"))}
+            ),
+        )
 
-pipeline_tool = agent_tool.AgentTool(agent=pipeline_agent)
 
-orchestrator_agent = Agent(
-    name="rubriq_orchestrator",
-    model=MODEL_NAME,
-    instruction=ORCHESTRATOR_INSTRUCTION,
-    tools=[pipeline_tool],
+# -------------------------------------------------------------------
+# Rubric compiler (point-annotated rubrics -> grading plan)
+# -------------------------------------------------------------------
+
+_POINTS = re.compile(
+    r"\(?\s*(?:(?:up\s+to|at\s+most|max(?:imum)?)[.:]?\s*)?"
+    r"(\d+(?:\.\d+)?)\s*(?:points?|pts?|marks?)\b(\s+total)?\s*\)?",
+    re.IGNORECASE,
 )
+# "Total: 100 points" states the rubric's maximum; it is checked, not graded.
+_TOTAL_LINE = re.compile(r"^(?:grand\s+|overall\s+)?total(?:\s+(?:points|score|marks))?$", re.IGNORECASE)
+
+
+@dataclass(frozen=True)
+class RubricCriterion:
+    name: str
+    max_score: float
+    category: Optional[str] = None
+    bonus: bool = False
+
+
+@dataclass(frozen=True)
+class GradingPlan:
+    criteria: tuple = ()
+    category_totals: tuple = ()  # (category, stated points, is_bonus)
+    errors: tuple = ()
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors and len(self.criteria) >= RUBRIC_MIN_CRITERIA
+
+    @property
+    def max_score(self) -> float:
+        return sum(c.max_score for c in self.criteria if not c.bonus)
+
+    @property
+    def bonus_score(self) -> float:
+        return sum(c.max_score for c in self.criteria if c.bonus)
+
+    def to_analysis_criteria(self) -> List[Dict[str, Any]]:
+        """Criteria in the analysis_result shape; bonus criteria are flagged."""
+        return [
+            {"name": c.name, "max_score": c.max_score, **({"bonus": True} if c.bonus else {})}
+            for c in self.criteria
+        ]
+
+
+def _points_value(raw: str) -> float:
+    value = float(raw)
+    return int(value) if value.is_integer() else value
+
+
+def _heading_before(lines: List[str], idx: int) -> Optional[str]:
+    """The heading a leading "(N points)" line belongs to: the previous line,
+    joined with the one before it when it is only a parenthetical continuation."""
+    prev = [l for l in lines[:idx] if l][-2:]
+    if not prev:
+        return None
+    title = prev[-1]
+    if len(prev) == 2 and title.startswith("(") and title.endswith(")"):
+        title = f"{prev[0]} {title}"
+    return title
+
+
+_LIST_MARKER = re.compile(r"^(\s*)(#{1,6}\s+)?([-*\u2022+]\s+|\d+[.)]\s+)?")
+
+
+def _line_depth(raw: str) -> int:
+    """Outline depth of a rubric line: markdown headings (by level) sit above
+    plain lines, which sit above indented and bulleted ones."""
+    indent, heading, bullet = _LIST_MARKER.match(raw).groups()
+    if heading:
+        return len(heading.strip())
+    return 10 + len(indent.expandtabs(4)) + (1 if bullet else 0)
+
+
+def _clean_title(title: str) -> str:
+    title = re.sub(r"^(#{1,6}\s*|[-*\u2022+]\s+|\d+[.)]\s+)", "", title.strip(" \t|"))
+    return title.strip(" \t-:\u2013*_|")
+
+
+def _plain_name(title: str) -> bool:
+    """False for names that are fragments of a larger structure (table cells, cut-off brackets)."""
+    return "|" not in title and all(title.count(o) == title.count(c) for o, c in ("()", "[]", "{}"))
+
+
+@functools.lru_cache(maxsize=128)
+def compile_rubric(rubric_text: str) -> GradingPlan:
+    """
+    Extract categories, criteria, point values and bonus sections from a
+    point-annotated rubric and check that stated category totals add up.
+    An entry is a category when the entries after it sum to its points and
+    either its wording ("Category", "Bonus", "N points total") or the outline
+    (headings, indentation, bullets) says so; a sum that only adds up by
+    coincidence in a flat list makes the plan invalid. A "Total: N points"
+    line must equal the non-bonus criteria sum, and names that are table
+    cells or cut-off brackets make the plan invalid too.
+    Cached, so a rubric shared by a cohort is compiled once.
+    """
+    raw_lines = (rubric_text or "").splitlines()
+    lines = [l.strip() for l in raw_lines]
+    entries = []  # (title, points, is_marker, depth)
+    stated_totals, errors = [], []
+    for idx, line in enumerate(lines):
+        match = _POINTS.search(line)
+        if not match:
+            continue
+        before = line[: match.start()].strip(" \t-:\u2013")
+        if before and match.start() > 0:
+            # "lose 5 points per day" is prose, not a criterion.
+            prose = not match.group(0).lstrip().startswith("(") and re.match(r"\s*\w", line[match.end():])
+            if prose or _clean_title(before)[:1].islower():
+                continue
+            title = before if len(before) <= 80 else re.split(r"[:.]", before)[0].strip()
+            depth = _line_depth(raw_lines[idx])
+        elif match.start() == 0:
+            title = _heading_before(lines, idx)
+            owner = max((i for i in range(idx) if lines[i]), default=idx)
+            depth = _line_depth(raw_lines[owner])
+        else:
+            title = None
+        title = _clean_title(title) if title else None
+        if title and _TOTAL_LINE.match(title):
+            stated_totals.append(_points_value(match.group(1)))
+        elif title:
+            if not _plain_name(title):
+                errors.append(f"'{title}' is not a plain criterion name.")
+            lowered = title.lower()
+            is_marker = bool(match.group(2)) or lowered.startswith("category") or "bonus" in lowered
+            entries.append((title, _points_value(match.group(1)), is_marker, depth))
+
+    criteria, totals = [], []
+    i = 0
+    while i < len(entries):
+        title, points, is_marker, depth = entries[i]
+        # Following entries whose points add up to this entry's.
+        members, subtotal = [], 0
+        for entry in entries[i + 1:]:
+            if entry[2] or subtotal >= points:
+                break
+            members.append(entry)
+            subtotal += entry[1]
+        summed = subtotal == points and members
+        nested = []
+        for entry in entries[i + 1:]:
+            if entry[3] <= depth:
+                break
+            nested.append(entry)
+        structural = is_marker or (members and all(m[3] > depth for m in members))
+
+        if summed and structural and (len(members) > 1 or is_marker or nested):
+            children = members
+        elif nested or is_marker:
+            # Outline or wording says category but the points do not add up.
+            children = nested
+            if not children:
+                for entry in entries[i + 1:]:
+                    if entry[2]:
+                        break
+                    children.append(entry)
+            if children:
+                subtotal = sum(c[1] for c in children)
+                errors.append(f"'{title}' states {points} points but its criteria sum to {subtotal}.")
+        elif summed and len(members) > 1:
+            errors.append(f"'{title}' equals the sum of the entries after it; cannot tell categories from criteria.")
+            children = members
+        else:
+            children = []
+
+        if not children and not is_marker:
+            criteria.append(RubricCriterion(title, points))
+            i += 1
+            continue
+        bonus = "bonus" in title.lower()
+        totals.append((title, points, bonus))
+        if not children:
+            # A category without sub-criteria is graded as one criterion.
+            criteria.append(RubricCriterion(title, points, title, bonus))
+        criteria.extend(RubricCriterion(c[0], c[1], title, bonus) for c in children)
+        i += 1 + len(children)
+
+    names = [c.name for c in criteria]
+    if len(set(names)) != len(names):
+        errors.append("Duplicate criterion names.")
+    max_score = sum(c.max_score for c in criteria if not c.bonus)
+    for stated in stated_totals:
+        if stated != max_score:
+            errors.append(f"Rubric states a total of {stated} points but its criteria sum to {max_score}.")
+    return GradingPlan(tuple(criteria), tuple(totals), tuple(errors))
+
+
+def _extractive_summary(writeup: str, max_chars: int = 400) -> str:
+    """First sentences of the writeup, used as the summary when analysis is compiled."""
+    text = " ".join(writeup.split())
+    if len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    end = cut.rfind(". ")
+    return cut[: end + 1] if end > 0 else cut.rstrip() + "..."
+
+
+RUBRIC_STATS = {"compiled": 0, "llm_fallback": 0}
+
+
+def rubric_compiler_report() -> Dict[str, Any]:
+    """Parse rate and analysis LLM calls avoided by the rubric compiler."""
+    total = RUBRIC_STATS["compiled"] + RUBRIC_STATS["llm_fallback"]
+    cache = compile_rubric.cache_info()
+    return {
+        **RUBRIC_STATS,
+        "parse_rate": (RUBRIC_STATS["compiled"] / total) if total else 0.0,
+        "analysis_calls_avoided": RUBRIC_STATS["compiled"],
+        "plan_cache_hits": cache.hits,
+    }
+
+
+class RubricAnalysisAgent(BaseAgent):
+    """
+    Analysis stage. Oversized submissions go through map_reduce_analysis;
+    otherwise analysis_result comes from the compiled rubric when it is
+    point-annotated and consistent, and from the LLM analysis agent if not.
+    """
+
+    def _emit(self, ctx: InvocationContext, result: Dict[str, Any]) -> Event:
+        text = json.dumps(result, ensure_ascii=False)
+        return Event(
+            author=self.name,
+            invocation_id=ctx.invocation_id,
+            branch=ctx.branch,
+            content=types.Content(role="model", parts=[types.Part(text=text)]),
+            actions=EventActions(state_delta={"analysis_result": text}),
+        )
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        result = await local_analysis(_payload_from_ctx(ctx), self.name)
+        if result is not None:
+            yield self._emit(ctx, result)
+            return
+        async for event in self.sub_agents[0].run_async(ctx):
+            yield event
+
+
+async def local_analysis(payload: Dict[str, Any], stage: str = "rubriq_analysis_stage") -> Optional[Dict[str, Any]]:
+    """
+    analysis_result without the analysis LLM: map-reduce for oversized
+    submissions, the compiled rubric otherwise. None means the LLM is needed.
+    """
+    plan = compile_rubric(payload.get("rubric_text", "")) if RUBRIC_COMPILER_ENABLED else None
+    compiled = plan is not None and plan.valid
+    if plan is not None:
+        RUBRIC_STATS["compiled" if compiled else "llm_fallback"] += 1
+
+    if MAP_REDUCE_ENABLED and _submission_chars(payload) > MAP_REDUCE_THRESHOLD_CHARS:
+        return await map_reduce_analysis(payload, plan if compiled else None)
+
+    if compiled:
+        return {
+            "summary": _extractive_summary(payload.get("project_writeup", "")),
+            "criteria": plan.to_analysis_criteria(),
+        }
+
+    if plan is not None and plan.errors:
+        logging.info("[%s] rubric not compiled: %s", stage, "; ".join(plan.errors))
+    return None
+
+
+# -------------------------------------------------------------------
+# Map-reduce analysis for submissions beyond the context window
+# -------------------------------------------------------------------
+
+# Top-level code boundaries: definitions, decorators and section banners.
+_CODE_BOUNDARY = re.compile(r"^(def |async def |class |@|# ?[-=]{3,}|# ?\d+\.|# ?%%)")
+_WRITEUP_BOUNDARY = re.compile(r"^(#{1,6} |\s*$)")
+
+
+def _submission_chars(payload: Dict[str, Any]) -> int:
+    return len(payload.get("code_text", "")) + len(payload.get("project_writeup", ""))
+
+
+def split_semantic(text: str, max_chars: int, kind: str = "code") -> List[str]:
+    """
+    Split at semantic boundaries (top-level definitions / section banners for
+    code, headings and paragraphs for writeups) and pack the blocks greedily
+    into chunks of at most `max_chars`; oversized blocks are split by lines.
+    """
+    boundary = _CODE_BOUNDARY if kind == "code" else _WRITEUP_BOUNDARY
+    blocks, current = [], []
+    for line in text.splitlines(keepends=True):
+        if current and boundary.match(line):
+            blocks.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        blocks.append("".join(current))
+
+    chunks, chunk = [], ""
+    for block in blocks:
+        if len(block) > max_chars:
+            pieces, piece = [], ""
+            for line in block.splitlines(keepends=True):
+                if len(line) > max_chars and piece:
+                    # Flush first, so slices of a long line keep their place.
+                    pieces.append(piece)
+                    piece = ""
+                while len(line) > max_chars:
+                    pieces.append(line[:max_chars])
+                    line = line[max_chars:]
+                if len(piece) + len(line) > max_chars:
+                    pieces.append(piece)
+                    piece = ""
+                piece += line
+            pieces.append(piece)
+        else:
+            pieces = [block]
+        for piece in pieces:
+            if chunk and len(chunk) + len(piece) > max_chars:
+                chunks.append(chunk)
+                chunk = ""
+            chunk += piece
+    if chunk.strip():
+        chunks.append(chunk)
+    return [c for c in chunks if c.strip()]
+
+
+def _direct_request(instruction: str, text: str) -> LlmRequest:
+    return LlmRequest(
+        model=MODEL_NAME,
+        contents=[types.Content(role="user", parts=[types.Part(text=text)])],
+        config=types.GenerateContentConfig(system_instruction=instruction),
+    )
+
+
+async def _call_model(stage: str, instruction: str, text: str) -> str:
+    """
+    One direct call through a stage model (deadline, hedging and cassette
+    apply); its usage calibrates token_estimator like an agent call would.
+    """
+    request = _direct_request(instruction, text)
+    chars = _request_chars(request)
+    final = ""
+    async for response in _stage_model(stage).generate_content_async(request):
+        if response.content and response.content.parts and not response.partial:
+            final = "".join(part.text or "" for part in response.content.parts)
+            token_estimator.observe(stage, chars, response)
+    return final
+
+
+# Chunk and reduce summaries by content hash (LRU), so unchanged chunks are
+# never summarised twice.
+_SUMMARY_CACHE: "OrderedDict[str, str]" = OrderedDict()
+MAP_REDUCE_STATS = {"gradings": 0, "chunks": 0, "map_calls": 0, "reduce_calls": 0, "cache_hits": 0}
+
+
+async def _cached_summary(stage: str, instruction: str, text: str, sem: asyncio.Semaphore) -> str:
+    key = hashlib.sha256(f"{stage}\0{instruction}\0{text}".encode("utf-8")).hexdigest()
+    if key in _SUMMARY_CACHE:
+        MAP_REDUCE_STATS["cache_hits"] += 1
+        _SUMMARY_CACHE.move_to_end(key)
+        return _SUMMARY_CACHE[key]
+
+    async def summarize() -> str:
+        async with sem:
+            result = await _call_model(stage, instruction, text)
+        MAP_REDUCE_STATS["map_calls" if stage == "rubriq_chunk_summarizer" else "reduce_calls"] += 1
+        return result
+
+    # Identical chunks within one submission (or across concurrent ones) share a call.
+    summary = await _summary_flights.run(key, summarize)
+    _SUMMARY_CACHE[key] = summary
+    while len(_SUMMARY_CACHE) > CHUNK_SUMMARY_CACHE_SIZE:
+        _SUMMARY_CACHE.popitem(last=False)
+    return summary
+
+
+async def map_reduce_analysis(payload: Dict[str, Any], plan: Optional[GradingPlan] = None) -> Dict[str, Any]:
+    """
+    Build analysis_result for an oversized submission: summarise chunks in
+    parallel (at most MAP_CONCURRENCY at a time), reduce the summaries
+    REDUCE_FAN_IN at a time until they fit one request, then infer criteria
+    with the analysis instruction (or take them from a compiled plan).
+    """
+    sem = asyncio.Semaphore(MAP_CONCURRENCY)
+    chunks = [
+        ("code", c) for c in split_semantic(payload.get("code_text", ""), MAP_CHUNK_CHARS, "code")
+    ] + [
+        ("writeup", c) for c in split_semantic(payload.get("project_writeup", ""), MAP_CHUNK_CHARS, "writeup")
+    ]
+    MAP_REDUCE_STATS["gradings"] += 1
+    MAP_REDUCE_STATS["chunks"] += len(chunks)
+
+    level = await asyncio.gather(
+        *(
+            _cached_summary(
+                "rubriq_chunk_summarizer",
+                CHUNK_SUMMARY_INSTRUCTION,
+                # No part index in the prompt: it would change every later
+                # chunk's cache key whenever a chunk is inserted.
+                f"[{kind} excerpt]\n{chunk}",
+                sem,
+            )
+            for kind, chunk in chunks
+        )
+    )
+
+    async def reduce(group: List[str]) -> str:
+        return await _cached_summary("rubriq_reduce_summarizer", REDUCE_INSTRUCTION, "\n\n---\n\n".join(group), sem)
+
+    while len(level) > REDUCE_FAN_IN:
+        groups = [level[i : i + REDUCE_FAN_IN] for i in range(0, len(level), REDUCE_FAN_IN)]
+        level = await asyncio.gather(*(reduce(list(g)) for g in groups))
+
+    if plan is not None:
+        summary = level[0] if len(level) == 1 else await reduce(list(level))
+        return {"summary": summary, "criteria": plan.to_analysis_criteria()}
+
+    query = json.dumps(
+        {"rubric_text": payload.get("rubric_text", ""), "submission_summary": "\n\n".join(level)},
+        ensure_ascii=False,
+    )
+    result = _parse_json_output(await _call_model("rubriq_analysis_agent", ANALYSIS_INSTRUCTION, query))
+    if not isinstance(result, dict) or not result.get("criteria"):
+        logging.warning("Map-reduce analysis returned no criteria; keeping the reduced summary only.")
+        return {"summary": "\n\n".join(level), "criteria": []}
+    return result
+
+
+def map_reduce_report() -> Dict[str, Any]:
+    """Chunk counts, model calls and cache hits of the map-reduce analysis."""
+    return {**MAP_REDUCE_STATS, "cached_summaries": len(_SUMMARY_CACHE)}
+
+
+# -------------------------------------------------------------------
+# Token estimation & budget admission control
+# -------------------------------------------------------------------
+
+CHARS_PER_TOKEN = 4.0
+STATIC_EVIDENCE_TOKENS = 200
+STAGE_OUTPUT_TOKENS = {
+    "rubriq_analysis_agent": 400,
+    "rubriq_scoring_agent": 800,
+    "rubriq_feedback_agent": 300,
+    "rubriq_orchestrator": 100,
+    "rubriq_chunk_summarizer": 200,
+    "rubriq_reduce_summarizer": 330,
+}
+
+
+class BudgetExceeded(RuntimeError):
+    """Raised when a submission cannot be fitted into its token budget."""
+
+
+def _request_chars(llm_request: LlmRequest) -> int:
+    instruction = llm_request.config.system_instruction if llm_request.config else None
+    chars = len(str(instruction or ""))
+    for content in llm_request.contents:
+        for part in content.parts or []:
+            if part.text:
+                chars += len(part.text)
+            elif part.function_call:
+                chars += len(json.dumps(part.function_call.args or {}, ensure_ascii=False))
+            elif part.function_response:
+                chars += len(json.dumps(part.function_response.response or {}, ensure_ascii=False, default=str))
+    return chars
+
+
+def _expected_criteria(rubric_text: str) -> int:
+    """Criteria an LLM analysis is likely to infer: point-annotated or list lines of the rubric."""
+    lines = [l for l in rubric_text.splitlines() if l.strip()]
+    marked = sum(1 for l in lines if _POINTS.search(l) or _LIST_MARKER.match(l).group(3))
+    return marked or SPECULATIVE_CRITERIA_ESTIMATE
+
+
+class TokenEstimator:
+    """
+    Character-based prompt token estimates per stage, calibrated against the
+    usage_metadata reported by the model (EMA of actual / estimated per stage).
+    """
+
+    def __init__(self, smoothing: float = 0.2):
+        self.smoothing = smoothing
+        self.calibration: Dict[str, float] = defaultdict(lambda: 1.0)
+        self.errors: Dict[str, LatencyTracker] = defaultdict(LatencyTracker)  # relative error samples
+        self._in_flight: Dict[tuple, int] = {}
+
+    def tokens(self, text: str, stage: Optional[str] = None) -> int:
+        raw = len(text) / CHARS_PER_TOKEN
+        return int(raw * (self.calibration[stage] if stage else 1.0))
+
+    def estimate(
+        self, payload: Dict[str, Any], feedback_mode: str = FEEDBACK_MODE, overlap: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Expected prompt tokens per stage for a payload, plus the total with
+        outputs. Oversized submissions are charged for their map-reduce chunk
+        and reduce calls instead of one analysis call over the whole payload.
+        With speculative overlap and an LLM analysis, every criterion is
+        scored by its own call that resends the submission.
+        """
+        query = json.dumps(payload, ensure_ascii=False)
+        out = STAGE_OUTPUT_TOKENS
+        chars, calls = {}, {}
+        evidence_chars = (STATIC_EVIDENCE_TOKENS if STATIC_CHECKS_ENABLED else 0) * CHARS_PER_TOKEN
+        llm_analysis = not (RUBRIC_COMPILER_ENABLED and compile_rubric(payload.get("rubric_text", "")).valid)
+        map_reduced = MAP_REDUCE_ENABLED and _submission_chars(payload) > MAP_REDUCE_THRESHOLD_CHARS
+        if map_reduced:
+            self._map_reduce_chars(payload, llm_analysis, chars, calls)
+        elif llm_analysis:
+            chars["rubriq_analysis_agent"] = len(ANALYSIS_INSTRUCTION) + len(query)
+        if llm_analysis and not map_reduced and (overlap or STAGE_OVERLAP) == "speculative":
+            n_criteria = _expected_criteria(payload.get("rubric_text", ""))
+            per_criterion = out["rubriq_analysis_agent"] / n_criteria
+            chars["rubriq_scoring_agent"] = n_criteria * (
+                len(SCORING_INSTRUCTION) + len(query) + per_criterion * CHARS_PER_TOKEN + evidence_chars
+            )
+            calls["rubriq_scoring_agent"] = n_criteria
+        else:
+            chars["rubriq_scoring_agent"] = (
+                len(SCORING_INSTRUCTION) + len(query) + out["rubriq_analysis_agent"] * CHARS_PER_TOKEN + evidence_chars
+            )
+        if feedback_mode == "llm":
+            chars["rubriq_feedback_agent"] = (
+                len(FEEDBACK_INSTRUCTION) + len(query)
+                + (out["rubriq_analysis_agent"] + out["rubriq_scoring_agent"]) * CHARS_PER_TOKEN
+            )
+        # Two orchestrator turns: the query, then query + tool call args + tool result.
+        tool_result = out["rubriq_feedback_agent" if feedback_mode == "llm" else "rubriq_scoring_agent"]
+        chars["rubriq_orchestrator"] = (
+            2 * len(ORCHESTRATOR_INSTRUCTION) + 3 * len(query) + tool_result * CHARS_PER_TOKEN
+        )
+
+        prompt = {
+            stage: int(n / CHARS_PER_TOKEN * self.calibration[stage]) for stage, n in chars.items()
+        }
+        output = sum(out[stage] * calls.get(stage, 1) for stage in prompt) + out["rubriq_orchestrator"]
+        return {"prompt_tokens": prompt, "total_tokens": sum(prompt.values()) + output}
+
+    @staticmethod
+    def _map_reduce_chars(
+        payload: Dict[str, Any], llm_analysis: bool, chars: Dict[str, float], calls: Dict[str, int]
+    ) -> None:
+        """Prompt chars and call counts of map_reduce_analysis, following its chunking and reduce tree."""
+        out = STAGE_OUTPUT_TOKENS
+        chunks = [
+            f"[{kind} excerpt]\n{chunk}"
+            for kind, text in (("code", payload.get("code_text", "")), ("writeup", payload.get("project_writeup", "")))
+            for chunk in split_semantic(text, MAP_CHUNK_CHARS, kind)
+        ]
+        chars["rubriq_chunk_summarizer"] = sum(len(CHUNK_SUMMARY_INSTRUCTION) + len(c) for c in chunks)
+        calls["rubriq_chunk_summarizer"] = len(chunks)
+
+        level, summary_chars = len(chunks), out["rubriq_chunk_summarizer"] * CHARS_PER_TOKEN
+        reduce_calls, reduce_chars = 0, 0.0
+        while level > REDUCE_FAN_IN or (level > 1 and not llm_analysis):
+            groups = -(-level // REDUCE_FAN_IN)
+            reduce_calls += groups
+            reduce_chars += groups * len(REDUCE_INSTRUCTION) + level * summary_chars
+            level, summary_chars = groups, out["rubriq_reduce_summarizer"] * CHARS_PER_TOKEN
+        if reduce_calls:
+            chars["rubriq_reduce_summarizer"] = reduce_chars
+            calls["rubriq_reduce_summarizer"] = reduce_calls
+        if llm_analysis:
+            chars["rubriq_analysis_agent"] = (
+                len(ANALYSIS_INSTRUCTION) + len(payload.get("rubric_text", "")) + level * summary_chars
+            )
+
+    # ADK model callbacks: estimate each real request, then compare with usage.
+    def before_model(self, callback_context, llm_request: LlmRequest) -> None:
+        key = (callback_context.invocation_id, callback_context.agent_name)
+        self._in_flight[key] = _request_chars(llm_request)
+        return None
+
+    def after_model(self, callback_context, llm_response: LlmResponse) -> None:
+        if llm_response.partial:
+            return None
+        stage = callback_context.agent_name
+        chars = self._in_flight.pop((callback_context.invocation_id, stage), None)
+        self.observe(stage, chars, llm_response)
+        return None
+
+    def observe(self, stage: str, chars: Optional[int], llm_response: LlmResponse) -> None:
+        """Calibrate `stage` with one completed call (also used by direct calls outside agents)."""
+        usage = llm_response.usage_metadata
+        if not chars or not usage or not usage.prompt_token_count:
+            return
+        estimated = chars / CHARS_PER_TOKEN * self.calibration[stage]
+        self.errors[stage].record(abs(usage.prompt_token_count - estimated) / usage.prompt_token_count)
+        ratio = usage.prompt_token_count / (chars / CHARS_PER_TOKEN)
+        self.calibration[stage] += self.smoothing * (ratio - self.calibration[stage])
+
+    def report(self) -> Dict[str, Any]:
+        report = {}
+        for stage in set(self.calibration) | set(self.errors):
+            errors = self.errors[stage]
+            report[stage] = {
+                "calibration": round(self.calibration[stage], 3),
+                "samples": len(errors),
+                "relative_error_p50": errors.percentile(50),
+                "relative_error_p95": errors.percentile(95),
+            }
+        return report
+
+
+token_estimator = TokenEstimator()
+
+
+def _trim_middle(text: str, max_chars: int, marker: str) -> str:
+    if len(text) <= max_chars:
+        return text
+    head = max(0, max_chars * 2 // 3)
+    tail = max(0, max_chars - head)
+    return f"{text[:head]}\n{marker}\n{text[len(text) - tail:] if tail else ''}"
+
+
+_DEF_LINE = re.compile(r"^(\s*)(async def |def )")
+
+
+def _elide_bodies(code_text: str, max_chars: int) -> str:
+    """
+    Cut only as much as needed, from the largest function bodies down: a body
+    is trimmed in the middle if that is enough, otherwise replaced by a marker.
+    """
+    lines = code_text.splitlines()
+    bodies = []  # (chars, first body line, end)
+    for idx, line in enumerate(lines):
+        match = _DEF_LINE.match(line)
+        if not match:
+            continue
+        indent = len(match.group(1))
+        start = idx + 1
+        while start < len(lines) and not lines[start - 1].rstrip().endswith(":"):
+            start += 1  # multi-line signature
+        end = start
+        while end < len(lines) and (not lines[end].strip() or len(lines[end]) - len(lines[end].lstrip()) > indent):
+            end += 1
+        bodies.append((sum(len(l) + 1 for l in lines[start:end]), start, end))
+
+    excess = len(code_text) - max_chars
+    replaced = {}  # first body line -> (end, replacement lines)
+    covered = []
+    for chars, start, end in sorted(bodies, reverse=True):
+        if excess <= 0:
+            break
+        if any(s <= start < e for s, e in covered) or chars < 200:
+            continue
+        body = lines[start:end]
+        pad = " " * (len(body[0]) - len(body[0].lstrip()))
+        marker = f"{pad}# ... [Rubriq: {{}} lines omitted to fit the token budget] ..."
+        if chars - excess > 400:
+            keep = chars - excess - len(marker)
+            head, tail, taken = [], [], 0
+            for line in body:
+                if taken + len(line) + 1 > keep * 2 // 3:
+                    break
+                head.append(line)
+                taken += len(line) + 1
+            for line in reversed(body[len(head):]):
+                if taken + len(line) + 1 > keep:
+                    break
+                tail.insert(0, line)
+                taken += len(line) + 1
+            omitted = len(body) - len(head) - len(tail)
+            new = head + [marker.format(omitted)] + tail
+        else:
+            new = [marker.format(len(body))]
+        excess -= chars - sum(len(l) + 1 for l in new)
+        replaced[start] = (end, new)
+        covered.append((start, end))
+
+    out, idx = [], 0
+    while idx < len(lines):
+        if idx in replaced:
+            end, new = replaced[idx]
+            out.extend(new)
+            idx = end
+        else:
+            out.append(lines[idx])
+            idx += 1
+    return "\n".join(out)
+
+
+def _trim_blocks(code_text: str, max_chars: int) -> str:
+    """Keep the head of every blank-line-separated block, cut in proportion to the excess."""
+    blocks = re.split(r"\n\s*\n", code_text)
+    small = sum(len(b) + 2 for b in blocks if len(b) <= 300)
+    large = sum(len(b) + 2 for b in blocks if len(b) > 300)
+    marker = "# ... [Rubriq: {} lines omitted to fit the token budget] ..."
+    ratio = (max_chars - small - len(marker) * len(blocks)) / large if large else 0.0
+    out = []
+    for block in blocks:
+        if len(block) <= 300:
+            out.append(block)
+            continue
+        lines = block.splitlines()
+        kept, taken = [], 0
+        for line in lines:
+            if kept and taken + len(line) + 1 > len(block) * ratio:
+                break
+            kept.append(line)
+            taken += len(line) + 1
+        if len(kept) < len(lines):
+            pad = " " * (len(kept[-1]) - len(kept[-1].lstrip()))
+            kept.append(pad + marker.format(len(lines) - len(kept)))
+        out.append("\n".join(kept))
+    return _trim_middle("\n\n".join(out), max_chars, "# ... [trimmed to fit the token budget] ...")
+
+
+def digest_code(code_text: str, max_chars: int) -> str:
+    """
+    Shrink code to `max_chars`, cutting no more than needed: the largest
+    function bodies are trimmed or elided first, then every block keeps a
+    proportional head. Only when less than a quarter could stay, keep structure
+    alone (imports, signatures, decorators, comments, UPPER_CASE assignments)
+    and trim its middle.
+    """
+    if len(code_text) <= max_chars:
+        return code_text
+    elided = _elide_bodies(code_text, max_chars)
+    if len(elided) <= max_chars:
+        return elided
+    if max_chars >= len(elided) // 4:
+        return _trim_blocks(elided, max_chars)
+    structural = re.compile(r"^\s*(#|@|def |async def |class |import |from |[A-Z_][A-Z0-9_]*\s*=)")
+    kept = [line for line in code_text.splitlines() if structural.match(line)]
+    digest = "\n".join(kept)
+    dropped = len(code_text.splitlines()) - len(kept)
+    digest = f"# [Rubriq digest: {dropped} body lines omitted to fit the token budget]\n{digest}"
+    return _trim_middle(digest, max_chars, "# ... [trimmed to fit the token budget] ...")
+
+
+@dataclass
+class AdmissionDecision:
+    action: str  # admit | downsize | reject
+    estimated_tokens: int
+    payload: Dict[str, Any]
+    reason: str = ""
+
+
+class AdmissionController:
+    """
+    Pre-flight budget check per submission and, optionally, per batch (all
+    submissions admitted through this controller).
+    """
+
+    def __init__(
+        self,
+        submission_budget: Optional[int] = SUBMISSION_TOKEN_BUDGET,
+        batch_budget: Optional[int] = BATCH_TOKEN_BUDGET,
+        estimator: TokenEstimator = token_estimator,
+    ):
+        self.submission_budget = submission_budget
+        self.batch_budget = batch_budget
+        self.estimator = estimator
+        self.batch_used = 0
+        self.stats = {"admitted": 0, "downsized": 0, "rejected": 0}
+
+    def _limit(self) -> Optional[int]:
+        limits = []
+        if self.submission_budget is not None:
+            limits.append(self.submission_budget)
+        if self.batch_budget is not None:
+            limits.append(self.batch_budget - self.batch_used)
+        return min(limits) if limits else None
+
+    def admit(
+        self, payload: Dict[str, Any], feedback_mode: str = FEEDBACK_MODE, overlap: Optional[str] = None
+    ) -> AdmissionDecision:
+        limit = self._limit()
+        estimate = self.estimator.estimate(payload, feedback_mode, overlap)["total_tokens"]
+        if limit is None or estimate <= limit:
+            return self._accept("admit", estimate, payload)
+
+        # Shrink the free-text inputs proportionally, searching for the largest
+        # factor whose estimate still fits.
+        code, writeup = payload.get("code_text", ""), payload.get("project_writeup", "")
+
+        def shrunk(factor: float) -> Dict[str, Any]:
+            return {
+                **payload,
+                "code_text": digest_code(code, int(len(code) * factor)),
+                "project_writeup": _trim_middle(
+                    writeup, int(len(writeup) * factor), "[... writeup trimmed to fit the token budget ...]"
+                ),
+            }
+
+        best = shrunk(0.0)
+        best_estimate = self.estimator.estimate(best, feedback_mode, overlap)["total_tokens"]
+        if best_estimate > limit:
+            self.stats["rejected"] += 1
+            return AdmissionDecision("reject", estimate, payload, f"needs ~{estimate} tokens, budget is {limit}")
+        lo, hi = 0.0, 1.0
+        while hi - lo > 0.005:
+            mid = (lo + hi) / 2
+            candidate = shrunk(mid)
+            candidate_estimate = self.estimator.estimate(candidate, feedback_mode, overlap)["total_tokens"]
+            if candidate_estimate <= limit:
+                best, best_estimate, lo = candidate, candidate_estimate, mid
+            else:
+                hi = mid
+        return self._accept("downsize", best_estimate, best, f"digested to fit {limit} tokens")
+
+    def _accept(self, action: str, estimate: int, payload: Dict[str, Any], reason: str = "") -> AdmissionDecision:
+        self.batch_used += estimate
+        self.stats["admitted" if action == "admit" else "downsized"] += 1
+        return AdmissionDecision(action, estimate, payload, reason)
+
+    def report(self) -> Dict[str, Any]:
+        return {**self.stats, "batch_used_tokens": self.batch_used, "batch_budget": self.batch_budget}
+
+
+admission_controller = AdmissionController()
+
+# -------------------------------------------------------------------
+# Feedback modes: llm | deferred | template
+# -------------------------------------------------------------------
+
+FEEDBACK_MODES = ("llm", "deferred", "template")
+
+
+def _parse_json_output(text: Optional[str]) -> Any:
+    """Parse an agent's STRICT JSON output, tolerating ```json fences."""
+    if not text:
+        return None
+    cleaned = re.sub(r"^\s*```(?:json)?\s*|\s*```\s*$", "", text.strip())
+    try:
+        return json.loads(cleaned)
+    except json.JSONDecodeError:
+        return None
+
+
+def render_feedback_template(analysis_result: Any, scoring_result: Any) -> str:
+    """Build overall_comment locally from the analysis summary and per-criterion scores."""
+    analysis = analysis_result if isinstance(analysis_result, dict) else {}
+    scoring = scoring_result if isinstance(scoring_result, dict) else {}
+    scores = [s for s in scoring.get("scores", []) if isinstance(s, dict)]
+
+    parts = []
+    if analysis.get("summary"):
+        parts.append(str(analysis["summary"]).strip())
+    if not scores:
+        parts.append("No criterion scores were produced, so no overall assessment is available.")
+        return " ".join(parts)
+
+    def number(value: Any) -> float:
+        try:
+            return float(value or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def ratio(s: Dict[str, Any]) -> float:
+        return number(s.get("score")) / (number(s.get("max_score")) or 1)
+
+    def reason(s: Dict[str, Any]) -> str:
+        return str(s.get("reason") or "").strip()
+
+    total = sum(number(s.get("score")) for s in scores)
+    max_total = sum(number(s.get("max_score")) for s in scores)
+    pct = f" ({total / max_total:.0%})" if max_total else ""
+    parts.append(f"Overall score: {total:g}/{max_total:g}{pct} across {len(scores)} criteria.")
+
+    ranked = sorted(scores, key=ratio)
+    best, worst = ranked[-1], ranked[0]
+    parts.append(
+        f"Strongest: {best.get('criterion')} ({best.get('score')}/{best.get('max_score')})"
+        f" - {reason(best)}"
+    )
+    if worst is not best:
+        parts.append(
+            f"Needs the most work: {worst.get('criterion')} ({worst.get('score')}/{worst.get('max_score')})"
+            f" - {reason(worst)}"
+        )
+    return " ".join(parts)
+
+
+def _final_json_event(agent: BaseAgent, ctx: InvocationContext, result: Dict[str, Any]) -> Event:
+    text = json.dumps(result, ensure_ascii=False)
+    return Event(
+        author=agent.name,
+        invocation_id=ctx.invocation_id,
+        branch=ctx.branch,
+        content=types.Content(role="model", parts=[types.Part(text=text)]),
+        actions=EventActions(state_delta={"rubriq_output": text}),
+    )
+
+
+class TemplateFeedbackAgent(BaseAgent):
+    """Feedback stage without a model call: overall_comment is rendered from the scores."""
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        comment = render_feedback_template(
+            _parse_json_output(ctx.session.state.get("analysis_result")),
+            _parse_json_output(ctx.session.state.get("scoring_result")),
+        )
+        yield _final_json_event(self, ctx, {"overall_comment": comment})
+
+
+class DeferredFeedbackAgent(BaseAgent):
+    """
+    Returns the scores immediately with a feedback ticket; the LLM comment is
+    generated later via feedback_queue (in the background or on demand).
+    """
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        analysis = _parse_json_output(ctx.session.state.get("analysis_result"))
+        scoring = _parse_json_output(ctx.session.state.get("scoring_result"))
+        ticket = feedback_queue.submit(analysis, scoring)
+        result = dict(scoring) if isinstance(scoring, dict) else {"scores": []}
+        result["feedback_ticket"] = ticket
+        yield _final_json_event(self, ctx, result)
+
+
+class FeedbackQueue:
+    """
+    Deferred overall comments keyed by ticket. Background tickets are worked off
+    by a small worker pool; the rest are generated on the first get(). Tickets
+    expire `ttl_s` after their last submit (a running generation is kept until
+    it finishes).
+    """
+
+    def __init__(self, workers: int = 2, ttl_s: float = FEEDBACK_TICKET_TTL_S):
+        self._workers = workers
+        self.ttl_s = ttl_s
+        self._pending: Dict[str, Any] = {}
+        self._results: Dict[str, asyncio.Future] = {}
+        self._submitted: "OrderedDict[str, float]" = OrderedDict()  # ticket -> last submit, oldest first
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self.latency = LatencyTracker()
+
+    def submit(self, analysis_result: Any, scoring_result: Any, background: Optional[bool] = None) -> str:
+        # Tickets are content hashes, so identical results share a comment and
+        # recorded runs replay byte-for-byte (no random ids in tool responses).
+        blob = json.dumps([analysis_result, scoring_result], sort_keys=True, ensure_ascii=False)
+        ticket = hashlib.sha256(blob.encode("utf-8")).hexdigest()[:32]
+        self._evict()
+        self._submitted[ticket] = time.monotonic()
+        self._submitted.move_to_end(ticket)
+        if ticket in self._pending or ticket in self._results:
+            return ticket
+        self._pending[ticket] = (analysis_result, scoring_result)
+        if DEFERRED_FEEDBACK_BACKGROUND if background is None else background:
+            if self._queue is None:
+                self._queue = asyncio.Queue()
+                self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self._workers)]
+            self._queue.put_nowait(ticket)
+        return ticket
+
+    def _evict(self) -> None:
+        cutoff = time.monotonic() - self.ttl_s
+        for ticket, submitted in list(self._submitted.items()):
+            if submitted > cutoff:
+                break
+            result = self._results.get(ticket)
+            if result is not None and not result.done():
+                continue
+            self.release(ticket)
+
+    def _start(self, ticket: str) -> asyncio.Future:
+        if ticket not in self._results:
+            if ticket not in self._pending:
+                raise KeyError(f"Unknown or expired feedback ticket: {ticket}")
+            analysis, scoring = self._pending.pop(ticket)
+            self._results[ticket] = asyncio.ensure_future(self._generate(analysis, scoring))
+        return self._results[ticket]
+
+    async def _generate(self, analysis_result: Any, scoring_result: Any) -> Dict[str, Any]:
+        started = time.perf_counter()
+        result = await generate_feedback(analysis_result, scoring_result)
+        self.latency.record(time.perf_counter() - started)
+        return result
+
+    async def _work(self) -> None:
+        while True:
+            ticket = await self._queue.get()
+            try:
+                if ticket in self._pending or ticket in self._results:  # not expired meanwhile
+                    await asyncio.gather(self._start(ticket), return_exceptions=True)
+            finally:
+                self._queue.task_done()
+
+    async def get(self, ticket: str) -> Dict[str, Any]:
+        """The {"overall_comment": ...} for a ticket, generating it now if needed."""
+        self._evict()
+        return await asyncio.shield(self._start(ticket))
+
+    def release(self, ticket: str) -> None:
+        """
+        Forget a ticket now instead of at expiry. Not done by get(), as
+        coalesced gradings share tickets.
+        """
+        self._pending.pop(ticket, None)
+        self._results.pop(ticket, None)
+        self._submitted.pop(ticket, None)
+
+    def __len__(self) -> int:
+        return len(self._submitted)
+
+
+feedback_queue = FeedbackQueue()
+
+
+# -------------------------------------------------------------------
+# Speculative stage overlap (analysis streamed into scoring)
+# -------------------------------------------------------------------
+
+STAGE_OVERLAP_MODES = ("sequential", "speculative")
+SPECULATIVE_STATS = {
+    "gradings": 0, "speculative_scores": 0, "used": 0, "cancelled": 0,
+    "late_scores": 0, "invalid_analysis": 0, "local_analysis": 0,
+}
+# Time to the first criterion score and end-to-end pipeline latency per mode,
+# recorded by benchmark_stage_overlap only.
+OVERLAP_LATENCY = {
+    mode: {"first_score": LatencyTracker(), "end_to_end": LatencyTracker()} for mode in STAGE_OVERLAP_MODES
+}
+
+
+class CriteriaStreamParser:
+    """
+    Incremental scanner over streamed analysis JSON: feed() returns each entry
+    of the top-level "criteria" array as soon as its closing brace arrives.
+    """
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_string: Optional[str] = None
+        self._array_depth: Optional[int] = None
+        self._item_start: Optional[int] = None
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self._buf += chunk
+        found = []
+        while self._pos < len(self._buf):
+            ch = self._buf[self._pos]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last_string = self._buf[self._string_start:self._pos]
+            elif ch == '"':
+                self._in_string = True
+                self._string_start = self._pos + 1
+            elif ch in "{[":
+                self._depth += 1
+                if ch == "[" and self._depth == 2 and self._last_string == "criteria":
+                    self._array_depth = self._depth
+                elif ch == "{" and self._array_depth is not None and self._depth == self._array_depth + 1:
+                    self._item_start = self._pos
+            elif ch in "}]":
+                if ch == "}" and self._item_start is not None and self._depth == self._array_depth + 1:
+                    try:
+                        item = json.loads(self._buf[self._item_start:self._pos + 1])
+                    except ValueError:
+                        item = None
+                    if isinstance(item, dict):
+                        found.append(item)
+                    self._item_start = None
+                elif ch == "]" and self._depth == self._array_depth:
+                    self._array_depth = None
+                self._depth -= 1
+            self._pos += 1
+        return found
+
+
+def _valid_criterion(criterion: Any) -> bool:
+    if not isinstance(criterion, dict) or not isinstance(criterion.get("name"), str):
+        return False
+    max_score = criterion.get("max_score")
+    return isinstance(max_score, (int, float)) and not isinstance(max_score, bool) and max_score > 0
+
+
+def _valid_analysis(analysis: Any) -> bool:
+    return (
+        isinstance(analysis, dict)
+        and isinstance(analysis.get("criteria"), list)
+        and bool(analysis["criteria"])
+        and all(_valid_criterion(c) for c in analysis["criteria"])
+    )
+
+
+class SpeculativeScoringAgent(BaseAgent):
+    """
+    Analysis, static checks and scoring with the stages overlapped: the
+    analysis is streamed and each criterion is scored as soon as it has been
+    emitted. Scores for criteria the final analysis drops or changes are
+    cancelled; if the final analysis is invalid, all speculative work is
+    cancelled and the sequential sub-agents (analysis, scoring) run instead.
+    A compiled (or map-reduced) analysis leaves nothing to overlap, so its
+    criteria are scored by the scoring sub-agent in one call.
+    """
+
+    def _state_event(self, ctx: InvocationContext, key: str, result: Dict[str, Any]) -> Event:
+        text = json.dumps(result, ensure_ascii=False)
+        return Event(
+            author=self.name,
+            invocation_id=ctx.invocation_id,
+            branch=ctx.branch,
+            content=types.Content(role="model", parts=[types.Part(text=text)]),
+            actions=EventActions(state_delta={key: text}),
+        )
+
+    async def _stream_analysis(self, payload: Dict[str, Any], on_criterion: Callable[[Dict[str, Any]], None]) -> Any:
+        request = _direct_request(ANALYSIS_INSTRUCTION, json.dumps(payload, ensure_ascii=False))
+        chars = _request_chars(request)
+        parser = CriteriaStreamParser()
+        streamed, final = "", None
+        async for response in _stage_model("rubriq_analysis_agent").generate_content_async(request, stream=True):
+            if not (response.content and response.content.parts):
+                continue
+            text = "".join(part.text or "" for part in response.content.parts)
+            if response.partial:
+                streamed += text
+                for criterion in parser.feed(text):
+                    on_criterion(criterion)
+            else:
+                final = text
+                token_estimator.observe("rubriq_analysis_agent", chars, response)
+        if final is None:
+            final = streamed
+        elif not streamed:
+            # Backend (or cassette) answered in one piece.
+            for criterion in parser.feed(final):
+                on_criterion(criterion)
+        return _parse_json_output(final)
+
+    async def _run_async_impl(self, ctx: InvocationContext) -> AsyncGenerator[Event, None]:
+        SPECULATIVE_STATS["gradings"] += 1
+        payload = _payload_from_ctx(ctx)
+        evidence = run_static_checks(payload) if STATIC_CHECKS_ENABLED else {}
+        yield Event(
+            author=self.name,
+            invocation_id=ctx.invocation_id,
+            branch=ctx.branch,
+            actions=EventActions(state_delta={"static_evidence": json.dumps(evidence, separators=(",", ":"))}),
+        )
+
+        analysis = await local_analysis(payload, self.name)
+        if analysis is not None:
+            # Nothing to overlap with: the scoring agent scores every criterion in one call.
+            SPECULATIVE_STATS["local_analysis"] += 1
+            yield self._state_event(ctx, "analysis_result", analysis)
+            async for event in self.sub_agents[1].run_async(ctx):
+                yield event
+            return
+
+        sem = asyncio.Semaphore(SPECULATIVE_CONCURRENCY)
+        tasks: Dict[str, tuple] = {}
+        first_score: List[float] = []
+
+        async def score(criterion: Dict[str, Any]) -> Dict[str, Any]:
+            item = {"payload": payload, "analysis_result": {"criteria": [criterion]}, "static_evidence": evidence}
+            async with sem:
+                scoring = await _score_single(item)
+            if not first_score:
+                first_score.append(time.perf_counter())
+            return scoring
+
+        def launch(criterion: Dict[str, Any]) -> None:
+            if _valid_criterion(criterion) and criterion["name"] not in tasks:
+                tasks[criterion["name"]] = (criterion, asyncio.ensure_future(score(criterion)))
+
+        def cancel(names: List[str]) -> None:
+            for name in names:
+                tasks.pop(name)[1].cancel()
+            SPECULATIVE_STATS["cancelled"] += len(names)
+
+        try:
+            analysis = await self._stream_analysis(payload, launch)
+            SPECULATIVE_STATS["speculative_scores"] += len(tasks)
+            if not _valid_analysis(analysis):
+                SPECULATIVE_STATS["invalid_analysis"] += 1
+                logging.info("[%s] invalid analysis; cancelling %d speculative scores.", self.name, len(tasks))
+                cancel(list(tasks))
+                for agent in self.sub_agents:
+                    async for event in agent.run_async(ctx):
+                        yield event
+                return
+            final = {c["name"]: c for c in analysis["criteria"]}
+            cancel([name for name, (c, _) in tasks.items() if final.get(name) != c])
+            SPECULATIVE_STATS["used"] += len(tasks)
+            for criterion in analysis["criteria"]:
+                if criterion["name"] not in tasks:
+                    SPECULATIVE_STATS["late_scores"] += 1
+                launch(criterion)
+            yield self._state_event(ctx, "analysis_result", analysis)
+
+            results = await asyncio.gather(*(tasks[c["name"]][1] for c in analysis["criteria"]))
+        finally:
+            for _, task in tasks.values():
+                task.cancel()
+
+        scores, retry = [], []
+        for criterion, scoring in zip(analysis["criteria"], results):
+            if _validate_scoring(scoring, {"criteria": [criterion]}):
+                scores.extend(scoring["scores"])
+            else:
+                retry.append(criterion)
+        if retry:
+            item = {"payload": payload, "analysis_result": {"criteria": retry}, "static_evidence": evidence}
+            scores.extend((await _score_single(item)).get("scores", []))
+
+        event = self._state_event(ctx, "scoring_result", {"scores": scores})
+        if first_score:
+            # When the first criterion score arrived (perf_counter), for benchmark_stage_overlap.
+            event.actions.state_delta["speculative_first_score_at"] = first_score[0]
+        yield event
+
+
+def stage_overlap_report() -> Dict[str, Any]:
+    """Speculation counters and time-to-first-score / end-to-end latency per overlap mode."""
+    report = {"speculation": dict(SPECULATIVE_STATS)}
+    for mode, trackers in OVERLAP_LATENCY.items():
+        report[mode] = {name: tracker.summary() for name, tracker in trackers.items()}
+    return report
+
+
+# -------------------------------------------------------------------
+# Build sub-agents (LLM)
+# -------------------------------------------------------------------
+
+def _build_feedback_agent() -> Agent:
+    return Agent(
+        name="rubriq_feedback_agent",
+        model=_stage_model("rubriq_feedback_agent"),
+        instruction=FEEDBACK_INSTRUCTION,
+        output_key="rubriq_output",
+        before_model_callback=token_estimator.before_model,
+        after_model_callback=token_estimator.after_model,
+    )
+
+
+def build_pipeline(feedback_mode: str = FEEDBACK_MODE, overlap: Optional[str] = None) -> SequentialAgent:
+    """
+    Build a fresh pipeline for a feedback mode and stage overlap (default: the
+    current STAGE_OVERLAP). Agents are created per call because an ADK agent
+    can only belong to one parent.
+    """
+    overlap = overlap or STAGE_OVERLAP
+    if feedback_mode not in FEEDBACK_MODES:
+        raise ValueError(f"Unknown feedback mode '{feedback_mode}'; expected one of {FEEDBACK_MODES}.")
+    if overlap not in STAGE_OVERLAP_MODES:
+        raise ValueError(f"Unknown stage overlap '{overlap}'; expected one of {STAGE_OVERLAP_MODES}.")
+
+    analysis_agent = Agent(
+        name="rubriq_analysis_agent",
+        model=_stage_model("rubriq_analysis_agent"),
+        instruction=ANALYSIS_INSTRUCTION,
+        output_key="analysis_result",
+        before_model_callback=token_estimator.before_model,
+        after_model_callback=token_estimator.after_model,
+    )
+
+    static_evidence_agent = StaticEvidenceAgent(
+        name="rubriq_static_checks",
+        description="Deterministic static checks on code_text and the writeup.",
+    )
+
+    scoring_agent = Agent(
+        name="rubriq_scoring_agent",
+        model=_stage_model("rubriq_scoring_agent"),
+        instruction=SCORING_INSTRUCTION,
+        output_key="scoring_result",
+        before_model_callback=token_estimator.before_model,
+        after_model_callback=token_estimator.after_model,
+    )
+
+    if feedback_mode == "template":
+        feedback_agent = TemplateFeedbackAgent(name="rubriq_feedback_agent")
+    elif feedback_mode == "deferred":
+        feedback_agent = DeferredFeedbackAgent(name="rubriq_feedback_agent")
+    else:
+        feedback_agent = _build_feedback_agent()
+
+    if overlap == "speculative":
+        # The speculative stage computes static evidence itself and falls back
+        # to the plain analysis and scoring agents.
+        return SequentialAgent(
+            name="rubriq_pipeline",
+            description="Pipelined: streamed analysis overlapped with per-criterion scoring, then feedback.",
+            sub_agents=[
+                SpeculativeScoringAgent(
+                    name="rubriq_speculative_stage",
+                    description="Scores each criterion as soon as the streamed analysis emits it.",
+                    sub_agents=[analysis_agent, scoring_agent],
+                ),
+                feedback_agent,
+            ],
+        )
+
+    if RUBRIC_COMPILER_ENABLED or MAP_REDUCE_ENABLED:
+        analysis_agent = RubricAnalysisAgent(
+            name="rubriq_analysis_stage",
+            description="Compiled rubric or map-reduce analysis with LLM fallback.",
+            sub_agents=[analysis_agent],
+        )
+
+    return SequentialAgent(
+        name="rubriq_pipeline",
+        description="Sequential pipeline: analysis, static checks, scoring, feedback.",
+        sub_agents=[analysis_agent]
+        + ([static_evidence_agent] if STATIC_CHECKS_ENABLED else [])
+        + [scoring_agent, feedback_agent],
+    )
+
+
+def build_orchestrator(feedback_mode: str = FEEDBACK_MODE, overlap: Optional[str] = None) -> Agent:
+    return Agent(
+        name="rubriq_orchestrator",
+        model=_stage_model("rubriq_orchestrator"),
+        instruction=ORCHESTRATOR_INSTRUCTION,
+        tools=[agent_tool.AgentTool(agent=build_pipeline(feedback_mode, overlap))],
+        before_model_callback=token_estimator.before_model,
+        after_model_callback=token_estimator.after_model,
+    )
+
+
+orchestrator_agent = build_orchestrator(FEEDBACK_MODE, STAGE_OVERLAP)
+pipeline_agent = orchestrator_agent.tools[0].agent
 
 root_agent = orchestrator_agent
 
@@ -176,20 +2207,156 @@ orchestrator_runner = Runner(
     session_service=session_service,
 )
 
+
+class EphemeralSessionService(BaseSessionService):
+    """
+    Session service for one-shot gradings: sessions are held by reference (no
+    copies on get, no app/user state) and only while a grading is running.
+    """
+
+    def __init__(self):
+        self._live: Dict[str, Session] = {}
+
+    async def create_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        state: Optional[Dict[str, Any]] = None,
+        session_id: Optional[str] = None,
+    ) -> Session:
+        session = Session(
+            id=session_id or uuid.uuid4().hex,
+            app_name=app_name,
+            user_id=user_id,
+            state=dict(state or {}),
+            last_update_time=time.time(),
+        )
+        self._live[session.id] = session
+        return session
+
+    async def get_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        config: Optional[GetSessionConfig] = None,
+    ) -> Optional[Session]:
+        return self._live.get(session_id)
+
+    async def list_sessions(self, *, app_name: str, user_id: Optional[str] = None) -> ListSessionsResponse:
+        return ListSessionsResponse(
+            sessions=[
+                s for s in self._live.values()
+                if s.app_name == app_name and (user_id is None or s.user_id == user_id)
+            ]
+        )
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        self._live.pop(session_id, None)
+
+    def release(self, session_id: str) -> None:
+        self._live.pop(session_id, None)
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+
+ephemeral_session_service = EphemeralSessionService()
+
+# One runner per (feedback mode, stage overlap); the defaults at import time
+# reuse orchestrator_runner.
+_MODE_RUNNERS: Dict[tuple, Runner] = {(FEEDBACK_MODE, STAGE_OVERLAP): orchestrator_runner}
+
+
+_EPHEMERAL_RUNNERS: Dict[tuple, Runner] = {}
+
+
+def _runner_config(runner_instance: Runner) -> tuple:
+    """(feedback mode, stage overlap) the runner's pipeline was built with."""
+    for config, runner in list(_MODE_RUNNERS.items()) + list(_EPHEMERAL_RUNNERS.items()):
+        if runner is runner_instance:
+            return config
+    return (FEEDBACK_MODE, STAGE_OVERLAP)
+
+
+def _ephemeral_twin(runner_instance: Runner) -> Runner:
+    """Same agent tree as `runner_instance`, backed by ephemeral_session_service."""
+    config = _runner_config(runner_instance)
+    if config not in _EPHEMERAL_RUNNERS:
+        _EPHEMERAL_RUNNERS[config] = Runner(
+            agent=runner_instance.agent,
+            app_name=f"{runner_instance.app_name}_ephemeral",
+            session_service=ephemeral_session_service,
+        )
+    return _EPHEMERAL_RUNNERS[config]
+
+
+def get_runner(feedback_mode: str = FEEDBACK_MODE, overlap: Optional[str] = None) -> Runner:
+    """Runner for a feedback mode and stage overlap (default: the current STAGE_OVERLAP)."""
+    config = (feedback_mode, overlap or STAGE_OVERLAP)
+    if config not in _MODE_RUNNERS:
+        suffix = feedback_mode if config[1] == "sequential" else f"{feedback_mode}_{config[1]}"
+        _MODE_RUNNERS[config] = Runner(
+            agent=build_orchestrator(*config),
+            app_name=f"{ORCH_APP_NAME}_{suffix}",
+            session_service=session_service,
+        )
+    return _MODE_RUNNERS[config]
+
+
+# Standalone feedback agent used by deferred mode.
+feedback_runner = Runner(
+    agent=_build_feedback_agent(),
+    app_name=f"{ORCH_APP_NAME}_feedback",
+    session_service=session_service,
+)
+
+
+async def generate_feedback(analysis_result: Any, scoring_result: Any) -> Dict[str, Any]:
+    """Run the LLM feedback agent on its own, in a session that is deleted afterwards."""
+    session = await session_service.create_session(app_name=feedback_runner.app_name, user_id=USER_ID)
+    query = json.dumps(
+        {"analysis_result": analysis_result, "scoring_result": scoring_result}, ensure_ascii=False
+    )
+    content = types.Content(role="user", parts=[types.Part(text=query)])
+    final_text = None
+    try:
+        async for event in feedback_runner.run_async(
+            user_id=USER_ID, session_id=session.id, new_message=content
+        ):
+            if event.is_final_response() and event.content and event.content.parts:
+                final_text = event.content.parts[0].text
+    finally:
+        await session_service.delete_session(
+            app_name=feedback_runner.app_name, user_id=USER_ID, session_id=session.id
+        )
+    return _parse_json_output(final_text) or {"overall_comment": final_text}
+
 # -------------------------------------------------------------------
 # Helper Function: run_session
 # -------------------------------------------------------------------
 
 USER_ID = "kaggle_user"
 
+# End-to-end grading latency per runner app (i.e. per feedback mode).
+GRADING_LATENCY: Dict[str, LatencyTracker] = {}
+
+
+def _record_grading_latency(app_name: str, seconds: float) -> None:
+    GRADING_LATENCY.setdefault(app_name, LatencyTracker()).record(seconds)
+
 async def run_session(
     runner_instance: Runner,
     user_queries: Union[List[str], str] = None,
     session_name: str = "default",
+    timeout_s: Optional[float] = GRADING_TIMEOUT_S,
 ):
     """
     Helper to run a conversation session in a Kaggle notebook.
     Prints the agent's output as it streams.
+    Each query is cancelled if it runs past `timeout_s` (None disables the deadline).
     """
     print(f"\n ### Session: {session_name}")
 
@@ -205,6 +2372,15 @@ async def run_session(
             app_name=app_name, user_id=USER_ID, session_id=session_name
         )
 
+    async def _stream(content: types.Content) -> None:
+        async for event in runner_instance.run_async(
+            user_id=USER_ID, session_id=session_name, new_message=content
+        ):
+            if event.content and event.content.parts:
+                text_part = event.content.parts[0].text
+                if text_part and text_part != "None":
+                    print(f"{MODEL_NAME} > {text_part}")
+
     if user_queries:
         if isinstance(user_queries, str):
             user_queries = [user_queries]
@@ -217,18 +2393,606 @@ async def run_session(
 
             content = types.Content(role="user", parts=[types.Part(text=query)])
 
-            # Stream response
-            async for event in runner_instance.run_async(
-                user_id=USER_ID, session_id=session_name, new_message=content
-            ):
-                if event.content and event.content.parts:
-                    text_part = event.content.parts[0].text
-                    if text_part and text_part != "None":
-                        print(f"{MODEL_NAME} > {text_part}")
+            # Stream response; wait_for cancels the run (and any in-flight
+            # model calls) once the grading deadline passes.
+            try:
+                started = time.perf_counter()
+                await asyncio.wait_for(_stream(content), timeout_s)
+                _record_grading_latency(app_name, time.perf_counter() - started)
+            except StageDeadlineExceeded as exc:
+                logging.warning("Grading aborted: %s", exc)
+                print(f"Grading aborted: {exc}")
+            except asyncio.TimeoutError:
+                logging.warning("Grading exceeded its %ss deadline.", timeout_s)
+                print(f"Grading timed out after {timeout_s}s.")
     else:
         print("No queries!")
 
 
+def _admit(
+    payload: Dict[str, Any], runner_instance: Runner, admission: Optional[AdmissionController]
+) -> Dict[str, Any]:
+    """The payload as `admission` lets it run (possibly digested); raises BudgetExceeded on rejection."""
+    if admission is None:
+        return payload
+    decision = admission.admit(payload, *_runner_config(runner_instance))
+    if decision.action == "reject":
+        raise BudgetExceeded(f"Submission rejected: {decision.reason}.")
+    if decision.action == "downsize":
+        logging.info("Submission downsized: %s (~%d tokens).", decision.reason, decision.estimated_tokens)
+    return decision.payload
+
+
+async def _grade_uncached(
+    payload: Dict[str, Any],
+    runner_instance: Runner,
+    user_id: str = USER_ID,
+    timeout_s: Optional[float] = GRADING_TIMEOUT_S,
+    ephemeral: bool = EPHEMERAL_SESSIONS,
+) -> Dict[str, Any]:
+    """Run one admitted payload through the runner in a fresh session."""
+    if ephemeral:
+        runner_instance = _ephemeral_twin(runner_instance)
+    app_name = runner_instance.app_name
+    sessions = runner_instance.session_service
+
+    session = await sessions.create_session(app_name=app_name, user_id=user_id)
+    query = json.dumps(payload, ensure_ascii=False)
+    content = types.Content(role="user", parts=[types.Part(text=query)])
+    final_text = None
+
+    async def _run() -> None:
+        nonlocal final_text
+        async for event in runner_instance.run_async(
+            user_id=user_id, session_id=session.id, new_message=content
+        ):
+            if event.is_final_response() and event.content and event.content.parts:
+                final_text = event.content.parts[0].text
+
+    started = time.perf_counter()
+    try:
+        await asyncio.wait_for(_run(), timeout_s)
+    finally:
+        if ephemeral:
+            ephemeral_session_service.release(session.id)
+        else:
+            await sessions.delete_session(app_name=app_name, user_id=user_id, session_id=session.id)
+    _record_grading_latency(app_name, time.perf_counter() - started)
+
+    result = _parse_json_output(final_text)
+    # The orchestrator may echo the tool response wrapper instead of its payload.
+    if isinstance(result, dict) and set(result) == {"result"} and isinstance(result["result"], str):
+        result = _parse_json_output(result["result"]) or result
+    return result if isinstance(result, dict) else {"raw_output": final_text}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one execution whose
+    result (or exception) every caller receives; optionally keeps completed
+    results for `ttl_s` seconds.
+    """
+
+    def __init__(self, ttl_s: float = RESULT_CACHE_TTL_S):
+        self.ttl_s = ttl_s
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._cache: Dict[str, tuple] = {}  # key -> (expires_at, result)
+        self.stats = {"executed": 0, "coalesced": 0, "cache_hits": 0}
+
+    async def run(self, key: str, factory: Callable[[], Any]) -> Any:
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                self.stats["cache_hits"] += 1
+                return copy.deepcopy(cached[1])
+            del self._cache[key]
+
+        task = self._inflight.get(key)
+        if task is None:
+            self.stats["executed"] += 1
+            task = asyncio.ensure_future(factory())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._settle(key, t))
+        else:
+            self.stats["coalesced"] += 1
+        # Shielded: one caller giving up must not cancel the shared execution.
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def _settle(self, key: str, task: asyncio.Future) -> None:
+        self._inflight.pop(key, None)
+        if self.ttl_s > 0 and not task.cancelled() and task.exception() is None:
+            now = time.monotonic()
+            for stale in [k for k, (expires, _) in self._cache.items() if expires <= now]:
+                del self._cache[stale]
+            self._cache[key] = (now + self.ttl_s, task.result())
+
+    def report(self) -> Dict[str, Any]:
+        return {**self.stats, "in_flight": len(self._inflight), "cached": len(self._cache)}
+
+
+grading_flights = SingleFlight()
+_summary_flights = SingleFlight(ttl_s=0.0)
+
+
+def _grading_key(payload: Dict[str, Any], runner_instance: Runner, ephemeral: bool) -> str:
+    """
+    Canonical hash of the admitted payload plus everything that shapes the
+    pipeline's output. Budgets are not part of it: every caller is admitted
+    by its own controller first, and a digested payload hashes differently.
+    """
+    config = {
+        "app": runner_instance.app_name,
+        "ephemeral": ephemeral,
+        "model": MODEL_NAME,
+        "instructions": [
+            ANALYSIS_INSTRUCTION, SCORING_INSTRUCTION, FEEDBACK_INSTRUCTION, ORCHESTRATOR_INSTRUCTION,
+            CHUNK_SUMMARY_INSTRUCTION, REDUCE_INSTRUCTION,
+        ],
+        "static_checks": STATIC_CHECKS_ENABLED,
+        "rubric_compiler": RUBRIC_COMPILER_ENABLED,
+        "map_reduce": [MAP_REDUCE_ENABLED, MAP_REDUCE_THRESHOLD_CHARS, MAP_CHUNK_CHARS, REDUCE_FAN_IN],
+        "overlap": _runner_config(runner_instance)[1],
+    }
+    blob = json.dumps({"payload": payload, "config": config}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+async def grade(
+    payload: Dict[str, Any],
+    runner_instance: Optional[Runner] = None,
+    user_id: str = USER_ID,
+    timeout_s: Optional[float] = GRADING_TIMEOUT_S,
+    admission: Optional[AdmissionController] = None,
+    ephemeral: bool = EPHEMERAL_SESSIONS,
+) -> Dict[str, Any]:
+    """
+    Programmatic counterpart of run_session: grade one payload in a fresh
+    session and return the orchestrator's final JSON as a dict.
+    With `ephemeral`, that session is a throwaway released on return.
+    The payload is first checked against `admission` (default: the global
+    admission_controller) and may be digested or rejected with BudgetExceeded.
+    With COALESCE_ENABLED, identical concurrent requests share one execution;
+    each caller is still admitted (and charged) by its own controller and
+    waits at most its own `timeout_s`.
+    """
+    runner_instance = runner_instance or get_runner()
+    admission = admission or (admission_controller if ADMISSION_CONTROL_ENABLED else None)
+    payload = _admit(payload, runner_instance, admission)
+    if not COALESCE_ENABLED:
+        return await _grade_uncached(payload, runner_instance, user_id, timeout_s, ephemeral)
+    key = _grading_key(payload, runner_instance, ephemeral)
+    flight = grading_flights.run(key, lambda: _grade_uncached(payload, runner_instance, user_id, timeout_s, ephemeral))
+    return await asyncio.wait_for(flight, timeout_s)
+
+
+def grading_latency_report() -> Dict[str, Any]:
+    """End-to-end grading latency percentiles per runner app / feedback mode."""
+    report = {app: tracker.summary() for app, tracker in GRADING_LATENCY.items()}
+    report["deferred_feedback_generation"] = feedback_queue.latency.summary()
+    report["coalescing"] = grading_flights.report()
+    return report
+
+
+async def benchmark_feedback_modes(
+    payload: Dict[str, Any], runs: int = 3, modes: tuple = FEEDBACK_MODES
+) -> Dict[str, Any]:
+    """Grade `payload` `runs` times per feedback mode and report end-to-end latency."""
+    for mode in modes:
+        for _ in range(runs):
+            await grade(payload, runner_instance=get_runner(mode))
+    report = grading_latency_report()
+    logging.info("Feedback mode latency: %s", json.dumps(report, indent=2))
+    return report
+
+
+async def benchmark_session_overhead(requests: int = 2000, concurrency: int = 100) -> Dict[str, Any]:
+    """
+    Session bookkeeping cost per grading, without model calls: create a session,
+    append the events of one pipeline run, read it back, then release it
+    (ephemeral) or delete it (as grade() does with session_service).
+    Compares session_service-style storage with ephemeral sessions.
+    """
+    authors = [
+        "user", "rubriq_analysis_stage", "rubriq_static_checks",
+        "rubriq_scoring_agent", "rubriq_feedback_agent", "rubriq_orchestrator",
+    ]
+
+    async def one(service: BaseSessionService, i: int) -> None:
+        session = await service.create_session(app_name="rubriq_bench", user_id=f"tenant_{i % 10}")
+        for author in authors:
+            event = Event(
+                author=author,
+                invocation_id=f"bench_{i}",
+                content=types.Content(role="model", parts=[types.Part(text='{"ok": true}')]),
+                actions=EventActions(state_delta={f"{author}_out": '{"ok": true}'}),
+            )
+            await service.append_event(session, event)
+        await service.get_session(app_name="rubriq_bench", user_id=session.user_id, session_id=session.id)
+        if isinstance(service, EphemeralSessionService):
+            service.release(session.id)
+        else:
+            await service.delete_session(app_name="rubriq_bench", user_id=session.user_id, session_id=session.id)
+
+    report = {}
+    for name, service in (("in_memory", InMemorySessionService()), ("ephemeral", EphemeralSessionService())):
+        started = time.perf_counter()
+        for offset in range(0, requests, concurrency):
+            await asyncio.gather(*(one(service, i) for i in range(offset, min(requests, offset + concurrency))))
+        elapsed = time.perf_counter() - started
+        listed = await service.list_sessions(app_name="rubriq_bench")
+        report[name] = {
+            "requests": requests,
+            "total_s": elapsed,
+            "per_request_us": elapsed / requests * 1e6,
+            "requests_per_s": requests / elapsed,
+            "sessions_retained": len(listed.sessions),
+        }
+    logging.info("Session overhead: %s", json.dumps(report, indent=2))
+    return report
+
+
+async def benchmark_stage_overlap(
+    payload: Dict[str, Any], runs: int = 3, feedback_mode: str = "template"
+) -> Dict[str, Any]:
+    """
+    Run the pipeline (without the orchestrator) `runs` times per overlap mode
+    and compare time-to-first-score and end-to-end latency. In sequential mode
+    the first score is available when the scoring stage's output arrives. Only
+    this benchmark records OVERLAP_LATENCY, so both modes are measured on the
+    same runs.
+    """
+    content = types.Content(role="user", parts=[types.Part(text=json.dumps(payload, ensure_ascii=False))])
+    for overlap in STAGE_OVERLAP_MODES:
+        runner = Runner(
+            agent=build_pipeline(feedback_mode, overlap),
+            app_name=f"{ORCH_APP_NAME}_overlap_{overlap}",
+            session_service=ephemeral_session_service,
+        )
+        for _ in range(runs):
+            session = await ephemeral_session_service.create_session(app_name=runner.app_name, user_id=USER_ID)
+            started = time.perf_counter()
+            try:
+                async for event in runner.run_async(user_id=USER_ID, session_id=session.id, new_message=content):
+                    delta = event.actions.state_delta
+                    if "scoring_result" in delta:
+                        first_at = delta.get("speculative_first_score_at", time.perf_counter())
+                        OVERLAP_LATENCY[overlap]["first_score"].record(first_at - started)
+            finally:
+                ephemeral_session_service.release(session.id)
+            OVERLAP_LATENCY[overlap]["end_to_end"].record(time.perf_counter() - started)
+    report = stage_overlap_report()
+    logging.info("Stage overlap: %s", json.dumps(report, indent=2))
+    return report
+
+
+# -------------------------------------------------------------------
+# Packed multi-submission scoring
+# -------------------------------------------------------------------
+
+PACKING_STATS = {
+    "submissions": 0, "packed_calls": 0, "packed_items": 0, "fallback_items": 0,
+    "unpacked_items": 0, "packed_prompt_tokens": 0, "unpacked_prompt_tokens": 0,
+}
+PACKING_THROUGHPUT = LatencyTracker()  # seconds per submission, one sample per batch
+# Seconds per submission: packed scoring calls (one sample per call, divided by
+# its items), individual scoring calls (fallbacks) and grade() for unpacked
+# submissions, so packed throughput can be compared with the unpacked path.
+PACKING_LATENCY = {
+    "packed_scoring": LatencyTracker(),
+    "individual_scoring": LatencyTracker(),
+    "unpacked_grading": LatencyTracker(),
+}
+
+
+def _validate_scoring(scoring: Any, analysis_result: Dict[str, Any]) -> bool:
+    """A scoring_result must score every analysed criterion once, within 0..max_score."""
+    if not isinstance(scoring, dict) or not isinstance(scoring.get("scores"), list):
+        return False
+    expected = {c.get("name") for c in analysis_result.get("criteria", []) if isinstance(c, dict)}
+    seen = set()
+    for entry in scoring["scores"]:
+        if not isinstance(entry, dict) or entry.get("criterion") not in expected:
+            return False
+        try:
+            score, max_score = float(entry["score"]), float(entry["max_score"])
+        except (KeyError, TypeError, ValueError):
+            return False
+        if not 0 <= score <= max_score:
+            return False
+        seen.add(entry["criterion"])
+    return seen == expected
+
+
+def _scoring_input(item: Dict[str, Any]) -> Dict[str, Any]:
+    payload = item["payload"]
+    return {
+        "project_writeup": payload.get("project_writeup", ""),
+        "code_text": payload.get("code_text", ""),
+        "analysis_result": item["analysis_result"],
+        "static_evidence": item["static_evidence"],
+    }
+
+
+async def _score_single(item: Dict[str, Any]) -> Dict[str, Any]:
+    evidence = json.dumps(item["static_evidence"], separators=(",", ":"))
+    instruction = SCORING_INSTRUCTION.replace("{static_evidence?}", evidence)
+    query = json.dumps(
+        {"rubric_text": item["payload"].get("rubric_text", ""), **_scoring_input(item)}, ensure_ascii=False
+    )
+    return _parse_json_output(await _call_model("rubriq_scoring_agent", instruction, query)) or {"scores": []}
+
+
+async def score_packed(rubric_text: str, items: List[Dict[str, Any]]) -> Dict[str, Dict[str, Any]]:
+    """
+    Score several submissions in one request and split the response back into
+    per-submission scoring_result objects. Submissions whose section is missing
+    or fails validation (or all of them, if the response does not parse) are
+    re-scored with individual calls.
+    """
+    sections = [f"RUBRIC:\n{rubric_text}"]
+    for item in items:
+        body = json.dumps(_scoring_input(item), ensure_ascii=False)
+        sections.append(f"<<<SUBMISSION id={item['id']}>>>\n{body}\n<<<END SUBMISSION id={item['id']}>>>")
+    packed_text = "\n\n".join(sections)
+
+    PACKING_STATS["packed_calls"] += 1
+    PACKING_STATS["packed_items"] += len(items)
+    PACKING_STATS["packed_prompt_tokens"] += token_estimator.tokens(PACKED_SCORING_INSTRUCTION + packed_text)
+    PACKING_STATS["unpacked_prompt_tokens"] += sum(
+        token_estimator.tokens(SCORING_INSTRUCTION + rubric_text + json.dumps(_scoring_input(i), ensure_ascii=False))
+        for i in items
+    )
+
+    started = time.perf_counter()
+    response = _parse_json_output(await _call_model("rubriq_scoring_agent", PACKED_SCORING_INSTRUCTION, packed_text))
+    PACKING_LATENCY["packed_scoring"].record((time.perf_counter() - started) / len(items))
+    by_id = {}
+    if isinstance(response, dict) and isinstance(response.get("results"), list):
+        by_id = {str(r.get("id")): r for r in response["results"] if isinstance(r, dict)}
+
+    results, retry = {}, []
+    for item in items:
+        scoring = by_id.get(str(item["id"]))
+        scoring = {"scores": scoring.get("scores")} if scoring else None
+        if _validate_scoring(scoring, item["analysis_result"]):
+            results[item["id"]] = scoring
+        else:
+            retry.append(item)
+    if retry:
+        logging.info("Packed scoring: %d of %d submissions fall back to individual calls.", len(retry), len(items))
+        PACKING_STATS["fallback_items"] += len(retry)
+
+        async def score_individually(item: Dict[str, Any]) -> Dict[str, Any]:
+            started = time.perf_counter()
+            scoring = await _score_single(item)
+            PACKING_LATENCY["individual_scoring"].record(time.perf_counter() - started)
+            return scoring
+
+        for item, scoring in zip(retry, await asyncio.gather(*(score_individually(i) for i in retry))):
+            results[item["id"]] = scoring
+    return results
+
+
+def _pack_bins(items: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    bins, current, size = [], [], 0
+    for item in items:
+        item_size = len(json.dumps(_scoring_input(item), ensure_ascii=False))
+        if current and (len(current) >= PACK_MAX_ITEMS or size + item_size > PACK_MAX_CHARS):
+            bins.append(current)
+            current, size = [], 0
+        current.append(item)
+        size += item_size
+    if current:
+        bins.append(current)
+    return bins
+
+
+async def _analyse_for_packing(payload: Dict[str, Any]) -> Dict[str, Any]:
+    result = await local_analysis(payload, "rubriq_packed_analysis")
+    if result is not None:
+        return result
+    text = await _call_model("rubriq_analysis_agent", ANALYSIS_INSTRUCTION, json.dumps(payload, ensure_ascii=False))
+    result = _parse_json_output(text)
+    return result if isinstance(result, dict) else {"summary": "", "criteria": []}
+
+
+async def grade_batch_packed(payloads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Grade a batch, packing small submissions that share a rubric into common
+    scoring requests. Comments are rendered from the scores (template feedback).
+    Large submissions go through grade() unchanged. Results keep input order.
+    """
+    started = time.perf_counter()
+    results: List[Optional[Dict[str, Any]]] = [None] * len(payloads)
+    groups: Dict[str, List[int]] = defaultdict(list)
+    large = []
+    for idx, payload in enumerate(payloads):
+        if _submission_chars(payload) <= PACK_MAX_SUBMISSION_CHARS:
+            groups[payload.get("rubric_text", "")].append(idx)
+        else:
+            large.append(idx)
+
+    async def grade_group(rubric_text: str, indices: List[int]) -> None:
+        analyses = await asyncio.gather(*(_analyse_for_packing(payloads[i]) for i in indices))
+        items = [
+            {
+                "id": f"s{i}",
+                "index": i,
+                "payload": payloads[i],
+                "analysis_result": analysis,
+                "static_evidence": run_static_checks(payloads[i]) if STATIC_CHECKS_ENABLED else {},
+            }
+            for i, analysis in zip(indices, analyses)
+        ]
+        scored = await asyncio.gather(*(score_packed(rubric_text, b) for b in _pack_bins(items)))
+        by_id = {k: v for part in scored for k, v in part.items()}
+        for item in items:
+            scoring = by_id[item["id"]]
+            results[item["index"]] = {
+                **scoring,
+                "overall_comment": render_feedback_template(item["analysis_result"], scoring),
+            }
+
+    async def grade_large(idx: int) -> None:
+        started = time.perf_counter()
+        results[idx] = await grade(payloads[idx])
+        PACKING_LATENCY["unpacked_grading"].record(time.perf_counter() - started)
+
+    await asyncio.gather(
+        *(grade_group(r, idx) for r, idx in groups.items()),
+        *(grade_large(i) for i in large),
+    )
+    PACKING_STATS["submissions"] += len(payloads)
+    PACKING_STATS["unpacked_items"] += len(large)
+    if payloads:
+        PACKING_THROUGHPUT.record((time.perf_counter() - started) / len(payloads))
+    return results
+
+
+def packing_report() -> Dict[str, Any]:
+    """
+    Packing efficiency (items per call, prompt tokens saved), batch throughput,
+    and per-submission scoring time packed vs. individually scored.
+    """
+    stats = dict(PACKING_STATS)
+    calls = stats["packed_calls"]
+    unpacked = stats["unpacked_prompt_tokens"]
+    mean_s = PACKING_THROUGHPUT.summary()["mean_s"]
+    stats["items_per_packed_call"] = (stats["packed_items"] / calls) if calls else 0.0
+    stats["prompt_tokens_saved_ratio"] = (1 - stats["packed_prompt_tokens"] / unpacked) if unpacked else 0.0
+    stats["submissions_per_s"] = (1 / mean_s) if mean_s else None
+    stats["seconds_per_submission"] = {name: tracker.summary() for name, tracker in PACKING_LATENCY.items()}
+    packed_s = stats["seconds_per_submission"]["packed_scoring"]["mean_s"]
+    individual_s = stats["seconds_per_submission"]["individual_scoring"]["mean_s"]
+    stats["scoring_speedup"] = (individual_s / packed_s) if packed_s and individual_s else None
+    return stats
+
+
+# -------------------------------------------------------------------
+# Scheduling: priority classes & weighted fair queuing across tenants
+# -------------------------------------------------------------------
+
+@dataclass
+class _Job:
+    tag: float
+    tenant: str
+    priority: str
+    payload: Dict[str, Any]
+    future: asyncio.Future
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+class GradingScheduler:
+    """
+    Admits gradings into the pipeline. Classes in PRIORITY_CLASSES are served
+    strictly in order; within a class each tenant gets capacity in proportion to
+    its weight (self-clocked fair queuing on virtual finish tags), and no tenant
+    runs more than `tenant_max_concurrency` gradings at once.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = SCHEDULER_MAX_CONCURRENCY,
+        tenant_max_concurrency: int = TENANT_MAX_CONCURRENCY,
+        weights: Optional[Dict[str, float]] = None,
+        runner_instance: Optional[Runner] = None,
+        admission: Optional[AdmissionController] = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.weights = weights or {}
+        self.runner_instance = runner_instance
+        self.admission = admission
+        self._queues: Dict[str, Dict[str, deque]] = {cls: {} for cls in PRIORITY_CLASSES}
+        self._finish_tags: Dict[tuple, float] = {}
+        self._virtual_time: Dict[str, float] = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self._running = 0
+        self._tenant_running: Dict[str, int] = defaultdict(int)
+        self.queue_wait = {cls: LatencyTracker() for cls in PRIORITY_CLASSES}
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "abandoned": 0}
+
+    async def submit(
+        self,
+        payload: Dict[str, Any],
+        tenant: str = USER_ID,
+        priority: str = "interactive",
+        cost: float = 1.0,
+    ) -> Dict[str, Any]:
+        """Queue a grading for `tenant` and wait for its result."""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class '{priority}'; expected one of {PRIORITY_CLASSES}.")
+        start = max(self._virtual_time[priority], self._finish_tags.get((priority, tenant), 0.0))
+        tag = start + cost / self.weights.get(tenant, 1.0)
+        self._finish_tags[(priority, tenant)] = tag
+
+        job = _Job(tag, tenant, priority, payload, asyncio.get_running_loop().create_future())
+        self._queues[priority].setdefault(tenant, deque()).append(job)
+        self.stats["submitted"] += 1
+        self._dispatch()
+        return await job.future
+
+    def _next_job(self) -> Optional[_Job]:
+        for priority in PRIORITY_CLASSES:
+            queues = self._queues[priority]
+            for tenant in list(queues):
+                # Callers that gave up while queued are dropped here.
+                while queues[tenant] and queues[tenant][0].future.done():
+                    queues[tenant].popleft()
+                    self.stats["abandoned"] += 1
+                if not queues[tenant]:
+                    del queues[tenant]
+            eligible = [
+                q[0] for tenant, q in queues.items()
+                if self._tenant_running[tenant] < self.tenant_max_concurrency
+            ]
+            if eligible:
+                job = min(eligible, key=lambda j: j.tag)
+                queues[job.tenant].popleft()
+                self._virtual_time[priority] = job.tag
+                return job
+        return None
+
+    def _dispatch(self) -> None:
+        while self._running < self.max_concurrency:
+            job = self._next_job()
+            if job is None:
+                return
+            self._running += 1
+            self._tenant_running[job.tenant] += 1
+            self.queue_wait[job.priority].record(time.perf_counter() - job.enqueued)
+            asyncio.ensure_future(self._run(job))
+
+    async def _run(self, job: _Job) -> None:
+        try:
+            result = await grade(
+                job.payload,
+                runner_instance=self.runner_instance,
+                user_id=job.tenant,
+                admission=self.admission,
+            )
+        except Exception as exc:
+            self.stats["failed"] += 1
+            if not job.future.done():
+                job.future.set_exception(exc)
+        else:
+            self.stats["completed"] += 1
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            self._running -= 1
+            self._tenant_running[job.tenant] -= 1
+            self._dispatch()
+
+    def report(self) -> Dict[str, Any]:
+        """Queue-wait latency per priority class, plus queue depth and counters."""
+        return {
+            **self.stats,
+            "running": self._running,
+            "queued": {cls: sum(len(q) for q in qs.values()) for cls, qs in self._queues.items()},
+            "queue_wait": {cls: tracker.summary() for cls, tracker in self.queue_wait.items()},
+        }
+
+
 # -------------------------------------------------------------------
 # Main Execution
 # -------------------------------------------------------------------
@@ -0,0 +1,48 @@
+"""
+Load selected top-level definitions from agent.py.
+
+agent.py is a notebook export: importing it builds the ADK runners and runs
+the demo. The pure helpers (rubric compiler, static checks, feedback
+templates) only need the standard library, so tests execute just those
+definitions in a fresh namespace.
+"""
+
+import ast
+import pathlib
+import types
+
+AGENT_PY = pathlib.Path(__file__).resolve().parent.parent / "agent.py"
+_FLAGS = ast.PyCF_ONLY_AST | ast.PyCF_ALLOW_TOP_LEVEL_AWAIT
+
+
+def _defined_names(node: ast.stmt) -> set:
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+        return {node.name}
+    if isinstance(node, ast.Assign):
+        return {t.id for t in node.targets if isinstance(t, ast.Name)}
+    if isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+        return {node.target.id}
+    return set()
+
+
+def load(*names: str, stubs: tuple = ()) -> types.SimpleNamespace:
+    """
+    Namespace with the stdlib imports of agent.py and the given definitions,
+    in file order. `stubs` names third-party types that only appear in
+    annotations of the loaded definitions (e.g. LlmRequest).
+    """
+    tree = compile(AGENT_PY.read_text(), str(AGENT_PY), "exec", flags=_FLAGS)
+    namespace = {"__name__": "agent_subset", **{name: object for name in stubs}}
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            try:
+                exec(compile(ast.Module([node], []), str(AGENT_PY), "exec"), namespace)
+            except ImportError:
+                pass  # third-party imports (ADK, IPython) are not needed by the helpers
+    wanted = set(names)
+    selected = [node for node in tree.body if _defined_names(node) & wanted]
+    missing = wanted - set().union(*(_defined_names(n) for n in selected))
+    if missing:
+        raise LookupError(f"not defined at top level of agent.py: {sorted(missing)}")
+    exec(compile(ast.Module(selected, []), str(AGENT_PY), "exec"), namespace)
+    return types.SimpleNamespace(**namespace)
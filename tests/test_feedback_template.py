@@ -0,0 +1,28 @@
+from agent_subset import load
+
+agent = load("render_feedback_template")
+
+
+def test_template_names_strongest_and_weakest_criteria():
+    comment = agent.render_feedback_template(
+        {"summary": "A grading agent."},
+        {"scores": [
+            {"criterion": "Design", "score": 9, "max_score": 10, "reason": "Clear stages."},
+            {"criterion": "Tests", "score": 2, "max_score": 10, "reason": "Few tests."},
+        ]},
+    )
+    assert comment.startswith("A grading agent. Overall score: 11/20 (55%)")
+    assert "Strongest: Design (9/10) - Clear stages." in comment
+    assert "Needs the most work: Tests (2/10) - Few tests." in comment
+
+
+def test_template_tolerates_null_and_non_numeric_fields():
+    comment = agent.render_feedback_template(
+        {},
+        {"scores": [
+            {"criterion": "Design", "score": 5, "max_score": 10, "reason": None},
+            {"criterion": "Tests", "score": "n/a", "max_score": None},
+        ]},
+    )
+    assert "Overall score: 5/10" in comment
+    assert "Strongest: Design (5/10) - " in comment
@@ -0,0 +1,73 @@
+import asyncio
+import itertools
+
+import pytest
+
+pytest.importorskip("google.adk")
+
+from agent_subset import load
+
+agent = load(
+    "STAGE_TIMEOUT_S", "HEDGE_ENABLED", "HEDGE_PERCENTILE", "HEDGE_MIN_SAMPLES", "HEDGE_HOLDOUT_EVERY",
+    "StageDeadlineExceeded", "LatencyTracker", "_clone_request", "ResilientLlm", "FakeLlm",
+)
+types = agent.types
+
+
+def _request():
+    return agent.LlmRequest(
+        model="fake",
+        contents=[types.Content(role="user", parts=[types.Part(text="{}")])],
+        config=types.GenerateContentConfig(system_instruction="test"),
+    )
+
+
+async def _call(llm, stream=False):
+    return [r async for r in llm.generate_content_async(_request(), stream=stream)]
+
+
+def test_hedging_cuts_the_tail_and_keeps_it_measurable():
+    # One call in 25 is slow; the rest take 10-30 ms.
+    counter = itertools.count()
+
+    def latency():
+        n = next(counter)
+        return 0.5 if n % 25 == 7 else 0.01 * (1 + n % 3)
+
+    llm = agent.ResilientLlm(
+        model="fake", stage="test", inner=agent.FakeLlm(model="fake", reply="{}", latency_fn=latency), timeout_s=5.0
+    )
+
+    async def run():
+        for _ in range(80):
+            await _call(llm)
+
+    asyncio.run(run())
+    report = llm.report()
+    assert report["hedged"] > 0 and report["hedge_wins"] > 0
+    # Losers cancelled by a winning hedge are still recorded.
+    assert report["backend_latency"]["count"] == report["calls"] + report["hedged"]
+    assert report["cancelled_losers"] == report["hedged"]
+    # Warm-up calls hit the slow backend unhedged; the baseline shows it,
+    # while hedged gradings never waited that long.
+    assert report["unhedged_latency"]["count"] >= agent.HEDGE_MIN_SAMPLES
+    assert max(llm._unhedged_latency._samples) >= 0.5
+    hedged_stage = list(llm._stage_latency._samples)[agent.HEDGE_MIN_SAMPLES:]
+    assert max(hedged_stage) < 0.5
+
+
+def test_deadline_cancels_slow_calls():
+    llm = agent.ResilientLlm(
+        model="fake", stage="test", inner=agent.FakeLlm(model="fake", latency_fn=lambda: 1.0), timeout_s=0.05
+    )
+    with pytest.raises(agent.StageDeadlineExceeded):
+        asyncio.run(_call(llm))
+    assert llm.report()["timeouts"] == 1
+
+
+def test_streamed_calls_without_deadline():
+    llm = agent.ResilientLlm(
+        model="fake", stage="test", inner=agent.FakeLlm(model="fake", reply='{"a": 1}'), timeout_s=None
+    )
+    responses = asyncio.run(_call(llm, stream=True))
+    assert responses[-1].content.parts[0].text == '{"a": 1}'
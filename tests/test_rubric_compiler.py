@@ -0,0 +1,57 @@
+import pytest
+
+from agent_subset import load
+
+agent = load(
+    "RUBRIC_MIN_CRITERIA", "_POINTS", "_TOTAL_LINE", "RubricCriterion", "GradingPlan",
+    "_points_value", "_heading_before", "_LIST_MARKER", "_line_depth", "_clean_title",
+    "_plain_name", "compile_rubric",
+)
+
+# Rubric text -> expected (name, max_score) criteria, or None when the plan
+# must be invalid (LLM analysis fallback).
+RUBRIC_SHAPES = {
+    "Part A: Design (40 points)\n- Clarity (20 points)\n- Correctness (20 points)\nPart B: Testing (10 points)":
+        [("Clarity", 20), ("Correctness", 20), ("Part B: Testing", 10)],
+    "## Code quality - 30 pts\n- Readability (15 pts)\n- Tests (15 pts)\n## Docs - 20 pts\n- README (20 pts)":
+        [("Readability", 15), ("Tests", 15), ("README", 20)],
+    "Clarity (20 points)\nCorrectness (20 points)\nLate submissions lose 5 points per day.":
+        [("Clarity", 20), ("Correctness", 20)],
+    "Category 1 (30 points total)\n- Idea (15 points)\n- Writeup (15 points)\nBonus (5 points)":
+        [("Idea", 15), ("Writeup", 15), ("Bonus", 5)],
+    "Design (40 points)\nClarity (20 points)\nCorrectness (20 points)": None,
+    "Part A: Design (40 points)\n- Clarity (20 points)\n- Correctness (10 points)": None,
+    # Grand totals are checked against the criteria, never graded.
+    "Clarity (20 points)\nCorrectness (30 points)\nStyle (50 points)\nTotal: 100 points":
+        [("Clarity", 20), ("Correctness", 30), ("Style", 50)],
+    "Clarity (20 points)\nCorrectness (30 points)\nGrand total: 60 points": None,
+    "Clarity (20 points)\nCorrectness (30 points)\nBonus (5 points)\n**Total** (50 points)":
+        [("Clarity", 20), ("Correctness", 30), ("Bonus", 5)],
+    # Qualified point values.
+    "Design (up to 10 points)\nTesting (max 5 pts)":
+        [("Design", 10), ("Testing", 5)],
+    # Markdown tables.
+    "| Criterion | Points |\n|---|---|\n| Design | 10 points |\n| Testing | 5 points |":
+        [("Design", 10), ("Testing", 5)],
+    "| Design | Architecture | 10 points |\n| Testing | Coverage | 5 points |": None,
+    "Design (see notes (10 points)\nTesting (5 points)": None,
+}
+
+
+@pytest.mark.parametrize("rubric, expected", RUBRIC_SHAPES.items(), ids=[r.splitlines()[0] for r in RUBRIC_SHAPES])
+def test_rubric_shapes(rubric, expected):
+    plan = agent.compile_rubric(rubric)
+    got = [(c.name, c.max_score) for c in plan.criteria] if plan.valid else None
+    assert got == expected, list(plan.errors)
+
+
+def test_total_line_is_not_a_criterion():
+    plan = agent.compile_rubric("Clarity (20 points)\nCorrectness (30 points)\nStyle (50 points)\nTotal: 100 points")
+    assert plan.valid
+    assert plan.max_score == 100
+
+
+def test_total_mismatch_is_reported():
+    plan = agent.compile_rubric("Clarity (20 points)\nCorrectness (30 points)\nTotal: 100 points")
+    assert not plan.valid
+    assert any("total of 100" in e for e in plan.errors)
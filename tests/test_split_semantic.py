@@ -0,0 +1,16 @@
+from agent_subset import load
+
+agent = load("_CODE_BOUNDARY", "_WRITEUP_BOUNDARY", "split_semantic")
+
+
+def test_chunks_keep_text_order_around_long_lines():
+    text = "x" * 30 + "\n" + "y" * 120
+    chunks = agent.split_semantic(text, 50, "code")
+    assert "".join(chunks) == text
+    assert all(len(c) <= 50 for c in chunks)
+
+
+def test_chunks_split_at_top_level_definitions():
+    text = "def a():\n    return 1\n\ndef b():\n    return 2\n"
+    chunks = agent.split_semantic(text, 25, "code")
+    assert chunks == ["def a():\n    return 1\n\n", "def b():\n    return 2\n"]
@@ -0,0 +1,43 @@
+import pytest
+
+from agent_subset import load
+
+agent = load(
+    "STATIC_CHECKS", "HEURISTIC_CHECKS", "static_check", "_check_comments", "_SETUP_STEPS", "_check_documentation",
+    "_SECRET_PATTERNS", "_PLACEHOLDER", "_EMAIL", "_PHONE_FORMATTED", "_PHONE_DIGITS", "_PHONE_CONTEXT",
+    "_digit_count", "_has_phone", "_check_secrets", "_AGENT_CONCEPTS", "_check_agent_concepts", "run_static_checks",
+)
+
+
+@pytest.mark.parametrize("line", [
+    'WHATSAPP_NUMBER = "6383969289"  # Without +91 for the link',
+    'contact = "+91 63839 69289"',
+    'support = "+14155552671"',
+    'office = "(415) 555-2671"',
+    'mobile: 9876543210',
+])
+def test_phone_numbers_are_found(line):
+    assert agent._has_phone(line)
+
+
+@pytest.mark.parametrize("line", [
+    "CREATED_AT = 1700000000000",
+    "TIMEOUT_MS = 30000000000",
+    "total = 1234567890 + offset",
+    'date = "2024-01-15"',
+    "amount = 10.000.000",
+])
+def test_plain_numbers_are_not_phones(line):
+    assert not agent._has_phone(line)
+
+
+def test_unparsable_payload_has_no_verified_facts():
+    evidence = agent.run_static_checks({})
+    assert "verified" not in evidence
+    assert "unavailable" in evidence
+
+
+def test_checks_are_grouped_into_verified_and_hints():
+    evidence = agent.run_static_checks({"code_text": "# entry point\nprint('hi')\n", "project_writeup": "A demo."})
+    assert evidence["verified"]["comments"]["comment_lines"] == 1
+    assert set(evidence["hints"]) == {"documentation", "agent_concepts"}
@@ -0,0 +1,47 @@
+from agent_subset import load
+
+agent = load(
+    "RUBRIC_MIN_CRITERIA", "RUBRIC_COMPILER_ENABLED", "STATIC_CHECKS_ENABLED", "FEEDBACK_MODE", "STAGE_OVERLAP",
+    "SPECULATIVE_CRITERIA_ESTIMATE", "MAP_REDUCE_ENABLED", "MAP_REDUCE_THRESHOLD_CHARS", "MAP_CHUNK_CHARS",
+    "REDUCE_FAN_IN", "ANALYSIS_INSTRUCTION", "SCORING_INSTRUCTION", "FEEDBACK_INSTRUCTION",
+    "ORCHESTRATOR_INSTRUCTION", "CHUNK_SUMMARY_INSTRUCTION", "REDUCE_INSTRUCTION", "LatencyTracker",
+    "_POINTS", "_TOTAL_LINE", "RubricCriterion", "GradingPlan", "_points_value", "_heading_before",
+    "_LIST_MARKER", "_line_depth", "_clean_title", "_plain_name", "compile_rubric",
+    "_CODE_BOUNDARY", "_WRITEUP_BOUNDARY", "_submission_chars", "split_semantic",
+    "CHARS_PER_TOKEN", "STATIC_EVIDENCE_TOKENS", "STAGE_OUTPUT_TOKENS", "_expected_criteria", "TokenEstimator",
+    stubs=("LlmRequest", "LlmResponse"),
+)
+
+UNSTRUCTURED = {
+    "rubric_text": "- Design\n- Testing\n- Documentation",
+    "project_writeup": "An agent that grades projects. " * 100,
+    "code_text": "def main():\n    return 1\n" * 200,
+}
+
+
+def test_speculative_estimate_charges_one_scoring_call_per_criterion():
+    estimator = agent.TokenEstimator()
+    sequential = estimator.estimate(UNSTRUCTURED, "llm", overlap="sequential")
+    speculative = estimator.estimate(UNSTRUCTURED, "llm", overlap="speculative")
+
+    scoring = sequential["prompt_tokens"]["rubriq_scoring_agent"]
+    assert speculative["prompt_tokens"]["rubriq_scoring_agent"] > 2.5 * scoring
+    extra_output = 2 * agent.STAGE_OUTPUT_TOKENS["rubriq_scoring_agent"]
+    extra_prompt = speculative["prompt_tokens"]["rubriq_scoring_agent"] - scoring
+    assert speculative["total_tokens"] == sequential["total_tokens"] + extra_prompt + extra_output
+
+
+def test_compiled_rubric_is_not_speculated():
+    payload = {**UNSTRUCTURED, "rubric_text": "Design (10 points)\nTesting (10 points)"}
+    estimator = agent.TokenEstimator()
+    assert estimator.estimate(payload, "template", overlap="speculative") == estimator.estimate(
+        payload, "template", overlap="sequential"
+    )
+
+
+def test_map_reduced_analysis_is_charged_per_chunk():
+    payload = {**UNSTRUCTURED, "code_text": "def f():\n    x = 1\n" * 10_000}
+    estimate = agent.TokenEstimator().estimate(payload, "template")
+    prompts = estimate["prompt_tokens"]
+    assert prompts["rubriq_chunk_summarizer"] > 0
+    assert prompts["rubriq_analysis_agent"] < len(payload["code_text"]) / agent.CHARS_PER_TOKEN / 10